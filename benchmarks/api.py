@@ -0,0 +1,191 @@
+"""
+Benchmarks of the thumbnails API endpoints.
+
+    python -m benchmarks.api --database sqlite --output bench.json
+    python -m benchmarks.compare baseline.json bench.json
+
+`--database postgres` runs against a test database created next to the one
+configured by POSTGRES_* environment variables.
+"""
+import argparse
+import base64
+
+from .utils import (
+    make_image,
+    measure,
+    report,
+    setup_django,
+    teardown_django,
+)
+
+
+def create_fixtures():
+    from django.contrib.auth import get_user_model
+
+    from thumbnails.models import Size, Tier
+
+    tiers = {
+        name: Tier.objects.create(
+            tier=name, original_image=name != Tier.Tiers.BASIC
+        )
+        for name in Tier.Tiers.values
+    }
+    for height, names in (
+        (200, Tier.Tiers.values),
+        (400, [Tier.Tiers.PREMIUM, Tier.Tiers.ENTERPRISE]),
+    ):
+        size = Size.objects.create(height=height)
+        size.tier.add(*[tiers[name] for name in names])
+    user = get_user_model().objects.create_user(
+        username="bench", password="bench", img_link_duration=300
+    )
+    user.tier = tiers[Tier.Tiers.ENTERPRISE]
+    user.save()
+    return user, tiers
+
+
+def upload(client, content):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    return client.post(
+        "/users/image/",
+        {"image": SimpleUploadedFile("bench.png", content, "image/png")},
+    )
+
+
+def run(args):
+    from django.conf import settings
+    from django.core.cache import caches
+    from rest_framework.test import APIClient
+
+    from thumbnails.models import Image, Tier
+
+    user, tiers = create_fixtures()
+    client = APIClient()
+    client.force_authenticate(user=user)
+    content = make_image(tuple(args.image_size))
+    encoded = base64.b64encode(content).decode()
+    results = []
+
+    results.append(
+        measure(
+            "upload_form",
+            lambda: upload(client, content),
+            args.iterations,
+            image_size=args.image_size,
+        )
+    )
+    results.append(
+        measure(
+            "upload_base64",
+            lambda: client.post(
+                "/users/image/", {"image": encoded}, format="json"
+            ),
+            args.iterations,
+            image_size=args.image_size,
+        )
+    )
+
+    image = Image.objects.filter(user=user).first()
+    thumbnail = image.thumbnails.filter(density=1).first()
+    image_link = image.generate_image_link()
+    results.append(
+        measure(
+            "retrieve_image",
+            lambda: client.get(f"/users/image/{image.token}"),
+            args.iterations,
+        )
+    )
+    results.append(
+        measure(
+            "retrieve_thumbnail",
+            lambda: client.get(f"/users/thumbnail/{thumbnail.token}"),
+            args.iterations,
+        )
+    )
+    results.append(
+        measure(
+            "retrieve_binary",
+            lambda: client.get(f"/users/binary/{image_link.token}"),
+            args.iterations,
+        )
+    )
+
+    def change_tier():
+        user.tier = (
+            tiers[Tier.Tiers.BASIC]
+            if user.tier == tiers[Tier.Tiers.ENTERPRISE]
+            else tiers[Tier.Tiers.ENTERPRISE]
+        )
+        user.save()
+        return ()
+
+    results.append(
+        measure(
+            "tier_change_propagation",
+            lambda: client.get(f"/users/thumbnail/{thumbnail.token}"),
+            args.iterations,
+            setup=change_tier,
+        )
+    )
+    user.tier = tiers[Tier.Tiers.ENTERPRISE]
+    user.save()
+
+    def clear_list_cache():
+        # lists are cached since the first request, cold runs render them
+        caches[settings.LIST_CACHE].clear()
+        return ()
+
+    for count in args.list_counts:
+        Image.objects.filter(user=user).delete()
+        for _ in range(count):
+            upload(client, content)
+        results.append(
+            measure(
+                "list_cold",
+                lambda: client.get("/users/image/"),
+                args.iterations,
+                setup=clear_list_cache,
+                images=count,
+            )
+        )
+        results.append(
+            measure(
+                "list",
+                lambda: client.get("/users/image/"),
+                args.iterations,
+                images=count,
+            )
+        )
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the thumbnails API."
+    )
+    parser.add_argument(
+        "--database", choices=["sqlite", "postgres"], default="sqlite"
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--image-size", type=int, nargs=2, default=[1024, 768]
+    )
+    parser.add_argument(
+        "--list-counts", type=int, nargs="+", default=[1, 10, 50]
+    )
+    parser.add_argument("--output", help="write JSON report to a file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    connection = setup_django(args.database)
+    try:
+        return report(run(args), args.output)
+    finally:
+        teardown_django(connection)
+
+
+if __name__ == "__main__":
+    main()
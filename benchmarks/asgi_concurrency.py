@@ -0,0 +1,143 @@
+"""
+Compares how many concurrent slow downloads a WSGI and an ASGI deployment
+can serve.
+
+Start both servers against the same database and media, e.g.:
+
+    gunicorn recruitment_task.wsgi -w 1 --threads 8 -b 127.0.0.1:8001
+    uvicorn recruitment_task.asgi:application --workers 1 --port 8002
+
+and run:
+
+    python -m benchmarks.asgi_concurrency \\
+        --target wsgi=http://127.0.0.1:8001/users/thumbnail/<token> \\
+        --target asgi=http://127.0.0.1:8002/users/async/thumbnail/<token> \\
+        --user test --password Test123 --concurrency 500
+"""
+import argparse
+import asyncio
+import base64
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def download(url, headers, read_size, read_delay, timeout):
+    parts = urlsplit(url)
+    started = time.perf_counter()
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, parts.port or 80),
+        timeout,
+    )
+    try:
+        request = [
+            f"GET {parts.path}?{parts.query} HTTP/1.1",
+            f"Host: {parts.netloc}",
+            "Connection: close",
+        ]
+        request += [f"{key}: {value}" for key, value in headers.items()]
+        writer.write(("\r\n".join(request) + "\r\n\r\n").encode("latin1"))
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        status = int(status_line.split()[1])
+        first_byte = time.perf_counter() - started
+        received = 0
+        while True:
+            chunk = await asyncio.wait_for(reader.read(read_size), timeout)
+            if not chunk:
+                break
+            received += len(chunk)
+            # simulate a slow client draining the socket
+            await asyncio.sleep(read_delay)
+        return status, first_byte, time.perf_counter() - started, received
+    finally:
+        writer.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run_target(name, url, args, headers):
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *[
+            download(
+                url, headers, args.read_size, args.read_delay, args.timeout
+            )
+            for _ in range(args.concurrency)
+        ],
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - started
+    ok = [
+        result
+        for result in results
+        if not isinstance(result, BaseException) and result[0] == 200
+    ]
+    first_byte = [result[1] for result in ok]
+    total = [result[2] for result in ok]
+    return {
+        "target": name,
+        "url": url,
+        "concurrency": args.concurrency,
+        "completed": len(ok),
+        "failed": len(results) - len(ok),
+        "elapsed": elapsed,
+        "throughput": len(ok) / elapsed if elapsed else None,
+        "bytes": sum(result[3] for result in ok),
+        "ttfb_p50": percentile(first_byte, 0.5),
+        "ttfb_p95": percentile(first_byte, 0.95),
+        "total_p50": percentile(total, 0.5),
+        "total_p95": percentile(total, 0.95),
+        "total_mean": statistics.mean(total) if total else None,
+    }
+
+
+async def main(args):
+    headers = {}
+    if args.user:
+        credentials = f"{args.user}:{args.password}".encode()
+        headers["Authorization"] = "Basic %s" % base64.b64encode(
+            credentials
+        ).decode()
+    if args.jwt:
+        headers["Authorization"] = f"Bearer {args.jwt}"
+    results = []
+    for target in args.target:
+        name, url = target.split("=", 1)
+        results.append(await run_target(name, url, args, headers))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare WSGI and ASGI concurrency on media endpoints."
+    )
+    parser.add_argument(
+        "--target",
+        action="append",
+        required=True,
+        help="name=url of an endpoint to download, may be repeated",
+    )
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--read-size", type=int, default=16 * 1024)
+    parser.add_argument(
+        "--read-delay",
+        type=float,
+        default=0.05,
+        help="seconds slept between reads to emulate slow clients",
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--user")
+    parser.add_argument("--password")
+    parser.add_argument("--jwt")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(main(parse_args())), indent=2))
@@ -0,0 +1,75 @@
+"""
+Compares two benchmark reports and exits with status 1 on regressions.
+
+    python -m benchmarks.compare baseline.json bench.json --threshold 0.2
+"""
+import argparse
+import json
+import sys
+
+METRICS = {
+    "p50": "lower",
+    "p95": "lower",
+    "p99": "lower",
+    "throughput": "higher",
+    "queries": "lower",
+    "peak_rss": "lower",
+}
+
+
+def key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare(baseline, current, threshold):
+    baseline = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = baseline.get(key(result))
+        if previous is None:
+            continue
+        for metric, better in METRICS.items():
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if better == "higher":
+                change = -change
+            if change > threshold:
+                regressions.append(
+                    {
+                        "name": result["name"],
+                        "params": result["params"],
+                        "metric": metric,
+                        "baseline": old,
+                        "current": new,
+                        "change": change,
+                    }
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare two benchmark reports."
+    )
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change treated as a regression",
+    )
+    args = parser.parse_args(argv)
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    regressions = compare(baseline, current, args.threshold)
+    print(json.dumps(regressions, indent=2))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
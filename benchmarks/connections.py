@@ -0,0 +1,97 @@
+"""
+Measures per-request database connection overhead on the Postgres
+database configured by POSTGRES_* and DB_HOST environment variables.
+
+    python -m benchmarks.connections --iterations 500
+
+Every iteration emulates a request: a query followed by the cleanup Django
+runs on request_finished. Compared setups are a new connection per request
+(CONN_MAX_AGE=0), persistent connections with health checks and the
+in-process pool.
+"""
+import argparse
+import os
+import time
+
+from .utils import percentile, report
+
+SETUPS = {
+    "new_connection": {
+        "ENGINE": "django.db.backends.postgresql",
+        "CONN_MAX_AGE": 0,
+        "CONN_HEALTH_CHECKS": False,
+    },
+    "persistent": {
+        "ENGINE": "django.db.backends.postgresql",
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
+    },
+    "pooled": {
+        "ENGINE": "recruitment_task.pooled_postgresql",
+        "CONN_MAX_AGE": 0,
+        "CONN_HEALTH_CHECKS": True,
+    },
+}
+
+
+def run_setup(name, iterations):
+    from django.conf import settings
+    from django.db.utils import ConnectionHandler
+
+    handler = ConnectionHandler(
+        {"default": {**settings.DATABASES["default"], **SETUPS[name]}}
+    )
+    connection = handler["default"]
+    timings = []
+    try:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            connection.close_if_unusable_or_obsolete()
+            timings.append(time.perf_counter() - started)
+    finally:
+        connection.close()
+    total = sum(timings)
+    return {
+        "name": "request_connection",
+        "params": {"setup": name},
+        "iterations": iterations,
+        "p50": percentile(timings, 0.5),
+        "p95": percentile(timings, 0.95),
+        "p99": percentile(timings, 0.99),
+        "mean": total / iterations,
+        "throughput": iterations / total if total else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark database connection setups."
+    )
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument(
+        "--setup", choices=list(SETUPS), action="append", default=None
+    )
+    parser.add_argument("--output", help="write JSON report to a file")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE", "recruitment_task.settings"
+    )
+    import django
+
+    django.setup()
+
+    from recruitment_task.pooled_postgresql.base import close_pools
+
+    results = [
+        run_setup(name, args.iterations) for name in args.setup or SETUPS
+    ]
+    close_pools()
+    return report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
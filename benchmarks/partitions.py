@@ -0,0 +1,163 @@
+"""
+Measures token lookup and image list latency with plain tables and with
+tables partitioned by shard, on a test database created next to the one
+configured by POSTGRES_* and DB_HOST environment variables.
+
+    python -m benchmarks.partitions --users 1000 --images 1000000
+
+Every setup runs in a fresh process and seeds the same number of rows with
+SQL (two thumbnails per image). `thumbnail_lookup` is the query of
+thumbnail view with shard hint of the token, `thumbnail_lookup_no_hint` the
+one of tokens issued before shards.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+
+from .utils import measure, report
+
+SETUPS = {"plain": False, "partitioned": True}
+
+
+def seed(users, images):
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+
+    from thumbnails.models import Tier
+
+    tier = Tier.objects.create(tier=Tier.Tiers.PREMIUM, original_image=True)
+    get_user_model().objects.bulk_create(
+        get_user_model()(username="bench%s" % index, tier=tier)
+        for index in range(users)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO thumbnails_image "
+            "(token, image, user_id, created_at, manifest, shard) "
+            "SELECT user_id %% %(shards)s || '.' || "
+            "substr(md5(g::text), 1, 22), 'bench.png', user_id, now(), "
+            "'{}', user_id %% %(shards)s "
+            "FROM (SELECT g, (SELECT min(id) FROM thumbnails_user) "
+            "+ g %% %(users)s AS user_id "
+            "FROM generate_series(1, %(images)s) g) rows",
+            {
+                "shards": settings.IMAGE_SHARDS,
+                "users": users,
+                "images": images,
+            },
+        )
+        cursor.execute(
+            "INSERT INTO thumbnails_thumbnail "
+            "(token, image_id, height, density, width, thumbnail, shard) "
+            "SELECT shard || '.' || substr(md5(id || '.' || height), 1, 22), "
+            "id, height, 1, height, 'bench.png', shard "
+            "FROM thumbnails_image, (VALUES (200), (400)) heights(height)"
+        )
+        cursor.execute("ANALYZE")
+        cursor.execute(
+            "SELECT token FROM thumbnails_thumbnail ORDER BY random() "
+            "LIMIT 1000"
+        )
+        tokens = [row[0] for row in cursor.fetchall()]
+    user_ids = list(get_user_model().objects.values_list("pk", flat=True))
+    return tokens, user_ids
+
+
+def run(name, users, images, iterations):
+    from .utils import setup_django, teardown_django
+
+    # read by settings before migrations of the test database run
+    os.environ["IMAGE_PARTITIONING"] = str(SETUPS[name])
+    connection = setup_django(database="postgres")
+
+    from thumbnails.models import Image, Thumbnail, shard_for_user
+    from thumbnails.views import shard_filter
+
+    tokens, user_ids = seed(users, images)
+    lookups = ("shard", "image__shard")
+
+    def thumbnail_lookup(token, hint=True):
+        filters = shard_filter(token, lookups) if hint else {}
+        return (
+            Thumbnail.objects.select_related("image__user__tier")
+            .filter(token=token, **filters)
+            .first()
+        )
+
+    def image_list(user_id):
+        return list(
+            Image.objects.filter(
+                user_id=user_id, shard=shard_for_user(user_id)
+            ).order_by("-created_at")[:50]
+        )
+
+    def token():
+        return (random.choice(tokens),)
+
+    try:
+        results = [
+            measure(
+                "thumbnail_lookup",
+                thumbnail_lookup,
+                iterations,
+                setup=token,
+                setup_name=name,
+                images=images,
+            ),
+            measure(
+                "thumbnail_lookup_no_hint",
+                lambda token: thumbnail_lookup(token, hint=False),
+                iterations,
+                setup=token,
+                setup_name=name,
+                images=images,
+            ),
+            measure(
+                "image_list",
+                image_list,
+                iterations,
+                setup=lambda: (random.choice(user_ids),),
+                setup_name=name,
+                images=images,
+            ),
+        ]
+    finally:
+        teardown_django(connection)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark partitioned image tables."
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--images", type=int, default=200000)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument(
+        "--setup", choices=list(SETUPS), action="append", default=None
+    )
+    parser.add_argument("--output", help="write JSON report to a file")
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in args.setup or SETUPS:
+        with context.Pool(1) as pool:
+            results.extend(
+                pool.apply(
+                    run, (name, args.users, args.images, args.iterations)
+                )
+            )
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE", "recruitment_task.settings"
+    )
+    import django
+
+    django.setup()
+    return report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Measures time and peak RSS of rendering thumbnails of one large original
+with the local-storage fast path (memory-mapped source, thumbnails written
+from encoder buffers) and through FieldFile reads and storage.save().
+
+    python -m benchmarks.render_memory --size 6000x4000 --iterations 5
+
+Every setup runs in a fresh process, so peak RSS of one doesn't hide the
+other. `rss_delta` is the peak growth over the process after Django setup.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+
+from .utils import make_image, measure, peak_rss, report
+
+SETUPS = {"fast_path": True, "field_file": False}
+
+
+def render(name, source, iterations, heights):
+    from .utils import setup_django, teardown_django
+
+    connection = setup_django()
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+    from django.core.files import File
+
+    from thumbnails.models import Image, Size, Tier
+
+    settings.THUMBNAIL_LOCAL_FAST_PATH = SETUPS[name]
+    tier = Tier.objects.create(tier=Tier.Tiers.ENTERPRISE)
+    for height in heights:
+        Size.objects.create(height=height).tier.add(tier)
+    user = get_user_model().objects.create_user(username="bench", tier=tier)
+    image = Image(user=user, token="bench")
+    with open(source, "rb") as file:
+        image.image.save(os.path.basename(source), File(file))
+
+    def setup():
+        image.thumbnails.all().delete()
+        return (heights,)
+
+    baseline = peak_rss()
+    try:
+        result = measure(
+            "render_thumbnails",
+            image.create_thumbnails,
+            iterations,
+            setup=setup,
+            setup_name=name,
+        )
+    finally:
+        teardown_django(connection)
+    result["rss_delta"] = result["peak_rss"] - baseline
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark memory of thumbnail rendering."
+    )
+    parser.add_argument("--size", default="6000x4000")
+    parser.add_argument("--format", default="JPEG")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--height", type=int, action="append", default=None
+    )
+    parser.add_argument("--output", help="write JSON report to a file")
+    args = parser.parse_args(argv)
+
+    width, height = map(int, args.size.split("x"))
+    directory = tempfile.mkdtemp(prefix="bench-source-")
+    source = os.path.join(directory, "source.%s" % args.format.lower())
+    with open(source, "wb") as file:
+        file.write(make_image((width, height), args.format))
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in SETUPS:
+        with context.Pool(1) as pool:
+            results.append(
+                pool.apply(
+                    render,
+                    (name, source, args.iterations, args.height or [200, 400]),
+                )
+            )
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE", "recruitment_task.settings"
+    )
+    import django
+
+    django.setup()
+    return report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+
+def setup_django(database="sqlite"):
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE", "recruitment_task.settings"
+    )
+    from django.conf import settings
+
+    if database == "sqlite":
+        settings.DATABASES["default"] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.path.join(tempfile.mkdtemp(), "bench.sqlite3"),
+        }
+    settings.MEDIA_ROOT = tempfile.mkdtemp(prefix="bench-media-")
+    settings.DEBUG = False
+    # benchmarks measure rendering, not admission control
+    settings.RENDER_RATES = {}
+    settings.RENDER_GLOBAL_RATE = None
+
+    import django
+
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    return connection
+
+
+def teardown_django(connection):
+    from django.test.utils import teardown_test_environment
+
+    connection.creation.destroy_test_db(
+        connection.settings_dict["NAME"], verbosity=0
+    )
+    teardown_test_environment()
+
+
+def make_image(size=(1024, 768), format="PNG"):
+    from PIL import Image
+
+    img_io = BytesIO()
+    Image.linear_gradient("L").resize(size).convert("RGB").save(
+        img_io, format=format
+    )
+    return img_io.getvalue()
+
+
+def peak_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def measure(name, func, iterations, setup=None, **params):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings = []
+    queries = []
+    for _ in range(iterations):
+        args = setup() if setup else ()
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = func(*args)
+            timings.append(time.perf_counter() - started)
+        if getattr(response, "status_code", 200) >= 400:
+            raise RuntimeError(
+                "%s returned %s" % (name, response.status_code)
+            )
+        queries.append(len(context.captured_queries))
+    total = sum(timings)
+    return {
+        "name": name,
+        "params": params,
+        "iterations": iterations,
+        "p50": percentile(timings, 0.5),
+        "p95": percentile(timings, 0.95),
+        "p99": percentile(timings, 0.99),
+        "mean": statistics.mean(timings),
+        "throughput": iterations / total if total else None,
+        "queries": max(queries),
+        "peak_rss": peak_rss(),
+    }
+
+
+def report(results, output=None):
+    from django.db import connection
+
+    payload = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "database": connection.vendor,
+        "created_at": time.time(),
+        "results": results,
+    }
+    data = json.dumps(payload, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(data)
+    else:
+        print(data)
+    return payload
@@ -0,0 +1,21 @@
+import os
+
+from recruitment_task.preload import post_fork as reset_connections
+from thumbnails.instrumentation import clear_metrics_dir
+
+wsgi_app = "recruitment_task.wsgi:application"
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+# application is imported once by the master and shared by workers
+preload_app = True
+
+
+def on_starting(server):
+    os.environ.setdefault(
+        "DJANGO_SETTINGS_MODULE", "recruitment_task.settings"
+    )
+    clear_metrics_dir()
+
+
+def post_fork(server, worker):
+    reset_connections()
@@ -0,0 +1,117 @@
+import os
+import threading
+
+from django.db.backends.postgresql import base, creation
+from psycopg2 import pool as psycopg2_pool
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class BlockingConnectionPool(psycopg2_pool.ThreadedConnectionPool):
+    # exhausted pool makes requests wait for a returned connection instead
+    # of failing at once
+    def __init__(self, minconn, maxconn, timeout, *args, **kwargs):
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconn)
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise base.Database.OperationalError(
+                "no connection returned to the pool within %s seconds"
+                % self.timeout
+            )
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        super().putconn(conn, key, close)
+        self._slots.release()
+
+
+def get_pool(alias, conn_params, settings_dict):
+    # pools are never shared with forked workers, test databases get
+    # their own pool as they differ in connection parameters
+    key = (alias, os.getpid(), repr(sorted(conn_params.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            options = settings_dict.get("POOL", {})
+            pool = _pools[key] = BlockingConnectionPool(
+                options.get("MIN", 1),
+                options.get("MAX", 10),
+                options.get("TIMEOUT", 10),
+                **conn_params,
+            )
+        return pool
+
+
+def close_pools():
+    with _pools_lock:
+        for key, pool in list(_pools.items()):
+            if key[1] == os.getpid():
+                pool.closeall()
+                del _pools[key]
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # pooled connections would keep the test database in use
+        close_pools()
+        return super()._destroy_test_db(test_database_name, verbosity)
+
+
+class PooledDatabase:
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+
+    def __getattr__(self, name):
+        return getattr(base.Database, name)
+
+    def connect(self, **conn_params):
+        pool = get_pool(
+            self.wrapper.alias, conn_params, self.wrapper.settings_dict
+        )
+        # after a restart of the server every idle connection is broken,
+        # each of them is dropped until a new one is opened
+        attempts = pool.maxconn + 1
+        while True:
+            connection = pool.getconn()
+            if not self.wrapper.settings_dict["CONN_HEALTH_CHECKS"]:
+                break
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                connection.rollback()
+                break
+            except base.Database.Error:
+                pool.putconn(connection, close=True)
+                attempts -= 1
+                if not attempts:
+                    raise
+        self.wrapper.pool = pool
+        return connection
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+    pool = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.Database = PooledDatabase(self)
+
+    def _close(self):
+        if self.connection is None:
+            return None
+        with self.wrap_database_errors:
+            if self.pool is None or self.pool.closed:
+                return self.connection.close()
+            try:
+                return self.pool.putconn(self.connection)
+            except psycopg2_pool.PoolError:
+                return self.connection.close()
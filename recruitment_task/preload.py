@@ -0,0 +1,20 @@
+from django.core.cache import caches
+from django.db import connections
+from django.urls import get_resolver
+
+
+def preload():
+    # URLconf imports views, serializers, DRF and simplejwt, which workers
+    # forked from a preloading master share instead of importing them on
+    # the first request
+    get_resolver().url_patterns
+    connections.close_all()
+    for cache in caches.all(initialized_only=True):
+        cache.close()
+
+
+def post_fork():
+    # sockets of connections opened by the master are shared with it, they
+    # are dropped without closing
+    for connection in connections.all(initialized_only=True):
+        connection.connection = None
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,8 @@ INSTALLED_APPS = [
     "thumbnails",
 ]
 MIDDLEWARE = [
+    "thumbnails.instrumentation.InstrumentationMiddleware",
+    "thumbnails.routers.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -79,15 +82,59 @@ import sys
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.postgresql",
+        # "recruitment_task.pooled_postgresql" keeps connections in
+        # in-process pool of POOL["MIN"]-POOL["MAX"] connections
+        "ENGINE": os.environ.get(
+            "DB_ENGINE", "django.db.backends.postgresql"
+        ),
         "NAME": os.environ.get("POSTGRES_DB"),
         "USER": os.environ.get("POSTGRES_USER"),
         "PASSWORD": os.environ.get("POSTGRES_PASSWORD"),
         "HOST": os.environ.get("DB_HOST"),
         "PORT": 5432,
+        # persistent connections, checked before reuse in the next request
+        "CONN_MAX_AGE": int(os.environ.get("CONN_MAX_AGE", 60)),
+        "CONN_HEALTH_CHECKS": (
+            os.environ.get("CONN_HEALTH_CHECKS", "True") == "True"
+        ),
+        # request waits up to TIMEOUT seconds when all MAX are in use
+        "POOL": {
+            "MIN": int(os.environ.get("DB_POOL_MIN", 1)),
+            "MAX": int(os.environ.get("DB_POOL_MAX", 10)),
+            "TIMEOUT": float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+        },
     }
 }
 
+# read replica for list and retrieve endpoints, tests run it as a mirror
+if os.environ.get("DB_REPLICA_HOST"):
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "NAME": os.environ.get(
+            "DB_REPLICA_NAME", DATABASES["default"]["NAME"]
+        ),
+        "HOST": os.environ["DB_REPLICA_HOST"],
+        "TEST": {"MIRROR": "default"},
+    }
+
+REPLICA_DATABASES = [alias for alias in DATABASES if alias != "default"]
+
+if REPLICA_DATABASES:
+    DATABASE_ROUTERS = ["thumbnails.routers.ReplicaRouter"]
+
+REPLICA_VIEWS = [
+    "image_list",
+    "image_view",
+    "thumbnail_view",
+    "binary_view",
+    "async_image_view",
+    "async_thumbnail_view",
+    "async_binary_view",
+]
+
+# seconds a client reads from primary after its write
+REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS", 10))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -135,10 +182,146 @@ MEDIA_ROOT = "/media/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 AUTH_USER_MODEL = "thumbnails.User"
+# Per-phase timings (SQL, Pillow, storage) of every request are added
+# as Server-Timing header and exported on /metrics
+SERVER_TIMING = os.environ.get("SERVER_TIMING", str(DEBUG)) == "True"
+# /metrics answers only these client addresses(comma separated) and staff.
+# Behind a local reverse proxy every client comes from loopback, so none is
+# allowed by default
+METRICS_ALLOWED_IPS = [
+    ip for ip in os.environ.get("METRICS_ALLOWED_IPS", "").split(",") if ip
+]
+# metrics of every worker process are written here and summed by /metrics,
+# empty value keeps them in each process
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR", os.path.join(tempfile.gettempdir(), "thumbnails_metrics")
+)
+# Opt-in profiling of thumbnails rendering. Renders slower than the
+# threshold(seconds) are appended to the slow render log, cProfile dumps
+# are saved only when THUMBNAIL_PROFILE_DIR is set
+THUMBNAIL_PROFILING = os.environ.get("THUMBNAIL_PROFILING") == "True"
+THUMBNAIL_SLOW_RENDER_THRESHOLD = float(
+    os.environ.get("THUMBNAIL_SLOW_RENDER_THRESHOLD", 1.0)
+)
+THUMBNAIL_SLOW_RENDER_LOG = os.environ.get(
+    "THUMBNAIL_SLOW_RENDER_LOG", BASE_DIR / "slow_renders.log"
+)
+THUMBNAIL_PROFILE_DIR = os.environ.get("THUMBNAIL_PROFILE_DIR")
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework.authentication.BasicAuthentication",
-        "rest_framework.authentication.SessionAuthentication",
         "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "rest_framework.authentication.SessionAuthentication",
+        "rest_framework.authentication.BasicAuthentication",
+    ),
+}
+# Media endpoints(image, thumbnail, binary) build user from JWT claims while
+# tier policy version is unchanged and cache verified Basic credentials
+MEDIA_AUTHENTICATION_CLASSES = os.environ.get(
+    "MEDIA_AUTHENTICATION_CLASSES",
+    "thumbnails.authentication.StatelessJWTAuthentication,"
+    "rest_framework.authentication.SessionAuthentication,"
+    "thumbnails.authentication.CachedBasicAuthentication",
+).split(",")
+SIMPLE_JWT = {
+    "TOKEN_OBTAIN_SERIALIZER": (
+        "thumbnails.authentication.TokenObtainPairSerializer"
     ),
 }
+# Caches are shared by worker processes, file based one works for workers
+# on one host, more hosts need e.g.
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND",
+            "django.core.cache.backends.filebased.FileBasedCache",
+        ),
+        "LOCATION": os.environ.get(
+            "CACHE_LOCATION",
+            os.path.join(tempfile.gettempdir(), "thumbnails_cache"),
+        ),
+    }
+}
+AUTH_CACHE = os.environ.get("AUTH_CACHE", "default")
+AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", 60))
+AUTH_BASIC_CACHE_TTL = int(os.environ.get("AUTH_BASIC_CACHE_TTL", 30))
+# Cached payloads of image list, expire sooner when some link expires
+LIST_CACHE = os.environ.get("LIST_CACHE", "default")
+LIST_CACHE_TTL = int(os.environ.get("LIST_CACHE_TTL", 300))
+# Host of media URLs in responses, e.g. "https://cdn.example.com", by
+# default the host of request
+MEDIA_DOMAIN = os.environ.get("MEDIA_DOMAIN", "")
+# Admission control of uploads and updates, which render thumbnails: token
+# bucket per user of tier, global one and concurrent renders per process
+RENDER_RATES = {
+    "BASIC": os.environ.get("RENDER_RATE_BASIC", "10/min"),
+    "PREMIUM": os.environ.get("RENDER_RATE_PREMIUM", "30/min"),
+    "ENTERPRISE": os.environ.get("RENDER_RATE_ENTERPRISE", "120/min"),
+}
+RENDER_GLOBAL_RATE = os.environ.get("RENDER_GLOBAL_RATE", "600/min")
+# buckets are rows of RenderBucket(DatabaseBuckets) or entries of
+# RENDER_THROTTLE_CACHE(CacheBuckets)
+RENDER_THROTTLE_BACKEND = os.environ.get(
+    "RENDER_THROTTLE_BACKEND", "thumbnails.throttling.DatabaseBuckets"
+)
+RENDER_THROTTLE_CACHE = os.environ.get("RENDER_THROTTLE_CACHE", "default")
+RENDER_CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", 4))
+RENDER_SLOT_TIMEOUT = float(os.environ.get("RENDER_SLOT_TIMEOUT", 10))
+# FileSystemStorage sources are memory-mapped and thumbnails are written
+# straight from encoder buffers
+THUMBNAIL_LOCAL_FAST_PATH = (
+    os.environ.get("THUMBNAIL_LOCAL_FAST_PATH", "True") == "True"
+)
+# Pillow plugins(PIL.<name>ImagePlugin) imported at startup besides
+# standard ones of Image.preinit, other formats are imported lazily by
+# Pillow. Empty value keeps lazy loading of all plugins
+THUMBNAIL_PILLOW_PLUGINS = [
+    plugin
+    for plugin in os.environ.get("THUMBNAIL_PILLOW_PLUGINS", "WebP").split(
+        ","
+    )
+    if plugin
+]
+# POSTs rendering thumbnails with Idempotency-Key header: duplicates wait
+# for the first request up to IDEMPOTENCY_WAIT seconds and get its stored
+# response for IDEMPOTENCY_TTL seconds
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 3600))
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", 15))
+IDEMPOTENCY_POLL_INTERVAL = 0.2
+# unfinished request refreshes its heartbeat every
+# IDEMPOTENCY_HEARTBEAT_INTERVAL seconds, the one without heartbeat for
+# IDEMPOTENCY_LOCK_TIMEOUT seconds(crashed worker) is taken over by its
+# duplicate
+IDEMPOTENCY_LOCK_TIMEOUT = int(
+    os.environ.get("IDEMPOTENCY_LOCK_TIMEOUT", 120)
+)
+IDEMPOTENCY_HEARTBEAT_INTERVAL = IDEMPOTENCY_LOCK_TIMEOUT / 4
+# Rows of images, thumbnails and links have shard of their user(user id
+# modulo IMAGE_SHARDS), which is also a prefix of their tokens, so at most
+# 100 shards fit(system check thumbnails.E002). Don't change it once
+# images exist. With IMAGE_PARTITIONING migration
+# 0012(or partition_images command) makes them Postgres tables partitioned
+# by shard
+IMAGE_SHARDS = int(os.environ.get("IMAGE_SHARDS", 16))
+IMAGE_PARTITIONING = os.environ.get("IMAGE_PARTITIONING") == "True"
+# Frames of animated thumbnails are sampled down to this budget
+THUMBNAIL_MAX_FRAMES = int(os.environ.get("THUMBNAIL_MAX_FRAMES", 50))
+# Admin changelists of bigger tables show estimated number of rows
+ADMIN_ESTIMATED_COUNT_THRESHOLD = int(
+    os.environ.get("ADMIN_ESTIMATED_COUNT_THRESHOLD", 100000)
+)
+# Resumable uploads, chunks are appended to files in UPLOAD_SESSION_DIR
+UPLOAD_SESSION_DIR = os.environ.get(
+    "UPLOAD_SESSION_DIR", os.path.join(tempfile.gettempdir(), "uploads")
+)
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))
+UPLOAD_MAX_LENGTH = int(os.environ.get("UPLOAD_MAX_LENGTH", 50 * 2**20))
+# Thumbnail URLs signed with HMAC for web server serving MEDIA_ROOT, keys
+# are "kid:secret" pairs separated by comma, the first one signs
+SIGNED_MEDIA_URLS = os.environ.get("SIGNED_MEDIA_URLS", "False") == "True"
+SIGNED_MEDIA_URL_TTL = int(os.environ.get("SIGNED_MEDIA_URL_TTL", 3600))
+SIGNED_MEDIA_KEYS = dict(
+    key.split(":", 1)
+    for key in os.environ.get("SIGNED_MEDIA_KEYS", "").split(",")
+    if key
+)
@@ -18,8 +18,10 @@ from django.urls import include, path
 from django.conf import settings
 from django.conf.urls.static import static
 from thumbnails import urls as thumbnails_urls
+from thumbnails.instrumentation import metrics_view
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view, name="metrics"),
     path("users/", include(thumbnails_urls.urlpatterns)),   
 ]
\ No newline at end of file
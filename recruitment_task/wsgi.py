@@ -11,6 +11,9 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
+from recruitment_task.preload import preload
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'recruitment_task.settings')
 
 application = get_wsgi_application()
+preload()
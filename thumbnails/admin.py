@@ -1,55 +1,173 @@
+from django.conf import settings
 from django.contrib import admin
-from django.urls import reverse
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
-from .models import Image, ImageLink, Size, Thumbnail, Tier, User
+from .models import (
+    Image,
+    ImageLink,
+    Size,
+    Thumbnail,
+    Tier,
+    User,
+    soft_delete_images,
+)
+from .utils import get_url_builder
+
+
+class EstimatedCountPaginator(Paginator):
+    # exact COUNT(*) of whole table is replaced by planner statistics
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        # soft deleted images hidden by their default manager are purged
+        # soon, estimate of the whole table is close enough
+        whole_table = (
+            queryset.query.where
+            == queryset.model._default_manager.all().query.where
+        )
+        if connection.vendor == "postgresql" and whole_table:
+            with connection.cursor() as cursor:
+                # partitioned table has statistics only in its partitions
+                cursor.execute(
+                    "SELECT SUM(reltuples) FROM pg_class "
+                    "WHERE relkind = 'r' AND (oid = %s::regclass OR oid IN "
+                    "(SELECT inhrelid FROM pg_inherits "
+                    "WHERE inhparent = %s::regclass))",
+                    [queryset.model._meta.db_table] * 2,
+                )
+                row = cursor.fetchone()
+            # small or never analyzed tables are counted exactly
+            if row[0] and row[0] >= settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                return int(row[0])
+        return super().count
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class SoftDeleteImagesAdmin(admin.ModelAdmin):
+    # images are soft deleted in bulk, listing them for confirmation would
+    # be as slow as cascade delete
+    images_lookup = None
+
+    def get_images(self, queryset):
+        return Image.all_objects.filter(
+            **{"%s__in" % self.images_lookup: queryset}
+        )
+
+    def get_deleted_objects(self, objs, request):
+        queryset = self.model._default_manager.filter(
+            pk__in=[obj.pk for obj in objs]
+        )
+        opts = self.model._meta
+        model_count = {
+            opts.verbose_name_plural: len(queryset),
+            Image._meta.verbose_name_plural: self.get_images(queryset).count(),
+        }
+        perms_needed = set()
+        for model in (self.model, Image):
+            if not self.admin_site._registry[model].has_delete_permission(
+                request
+            ):
+                perms_needed.add(model._meta.verbose_name)
+        return [str(obj) for obj in queryset], model_count, perms_needed, []
+
+    def delete_queryset(self, request, queryset):
+        soft_delete_images(self.get_images(queryset))
+        return super().delete_queryset(request, queryset)
 
 
 @admin.action(description="Generate expiring link to image")
 def generate_expiring_link(modeladmin, request, queryset):
-    for image in queryset:
+    for image in queryset.select_related("user"):
         image.generate_image_link()
     return None
 
 
-class ImageAdmin(admin.ModelAdmin):
+class ImageAdmin(ScalableAdmin):
     readonly_fields = ["url"]
     fields = (
         "image",
         "user",
         "url",
     )
+    list_display = ("id", "token", "user", "created_at", "url")
+    list_select_related = ("user",)
+    list_filter = ("created_at", "user__tier")
+    raw_id_fields = ("user",)
 
     actions = [generate_expiring_link]
 
+    def get_readonly_fields(self, request, obj=None):
+        # rows and tokens of the image keep shard of the owner it was
+        # uploaded by
+        if obj is not None:
+            return self.readonly_fields + ["user"]
+        return self.readonly_fields
+
     def save_model(self, request, obj, form, change) -> None:
         return obj.save_generated_token()
 
+    def delete_model(self, request, obj):
+        obj.soft_delete()
+
+    def delete_queryset(self, request, queryset):
+        for image in queryset:
+            image.soft_delete()
+
     def get_queryset(self, request):
         self.request = request
         return super().get_queryset(request)
 
     @admin.display(description="Url")
     def url(self, obj):
-        return self.request.build_absolute_uri(
-            f"{reverse(f'image_view', kwargs={'token': obj.token})}"
-        )
+        return get_url_builder(self.request).url("image_view", obj.token)
 
 
-class TierAdmin(admin.ModelAdmin):
+class TierAdmin(SoftDeleteImagesAdmin):
+    images_lookup = "user__tier"
     readonly_fields = ["size_list"]
     fields = (
         "tier",
         "size_list",
-        "original_image"
+        "original_image",
+        "animated_thumbnails",
     )
+    list_display = ("tier", "size_list", "original_image")
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related("sizes")
+
     @admin.display(description="Thumbnails sizes")
     def size_list(self, obj):
         return [size.height for size in obj.sizes.all()]
 
 
-admin.site.register(ImageLink)
+class UserAdmin(SoftDeleteImagesAdmin):
+    images_lookup = "user"
+
+
+class ThumbnailAdmin(ScalableAdmin):
+    list_display = ("id", "token", "image", "height", "density", "width")
+    list_select_related = ("image",)
+    raw_id_fields = ("image",)
+
+
+class ImageLinkAdmin(ScalableAdmin):
+    list_display = ("id", "token", "image", "valid_until")
+    list_select_related = ("image",)
+    list_filter = ("valid_until",)
+    raw_id_fields = ("image",)
+
+
+admin.site.register(ImageLink, ImageLinkAdmin)
 admin.site.register(Size)
-admin.site.register(Thumbnail)
-admin.site.register(User)
+admin.site.register(Thumbnail, ThumbnailAdmin)
+admin.site.register(User, UserAdmin)
 admin.site.register(Tier, TierAdmin)
 admin.site.register(Image, ImageAdmin)
@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class ThumbnailsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'thumbnails'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+
+        from . import checks, signals  # noqa: F401
+        from .instrumentation import install_sql_wrapper
+        from .utils import init_pillow
+
+        connection_created.connect(install_sql_wrapper)
+        init_pillow(settings.THUMBNAIL_PILLOW_PLUGINS)
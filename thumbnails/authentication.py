@@ -0,0 +1,154 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from rest_framework.authentication import BasicAuthentication
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.serializers import (
+    TokenObtainPairSerializer as BaseTokenObtainPairSerializer,
+)
+
+from .models import Tier
+
+
+def get_cache():
+    return caches[settings.AUTH_CACHE]
+
+
+def user_key(user_id):
+    return "auth:user:%s" % user_id
+
+
+def tier_key(tier_id):
+    return "auth:tier:%s" % tier_id
+
+
+def policy_claims(user):
+    tier = user.tier
+    return {
+        "tier_id": tier.id if tier else None,
+        "tier": tier.tier if tier else None,
+        "original_image": tier.original_image if tier else False,
+        "animated_thumbnails": tier.animated_thumbnails if tier else False,
+        "policy_version": tier.policy_version if tier else None,
+    }
+
+
+def get_user_policy(user_id):
+    cache = get_cache()
+    policy = cache.get(user_key(user_id))
+    if policy is None:
+        user = (
+            get_user_model()
+            .objects.filter(pk=user_id, is_active=True)
+            .values("tier_id", "username")
+            .first()
+        )
+        if user is None:
+            return None
+        policy = (user["tier_id"], user["username"])
+        cache.set(user_key(user_id), policy, settings.AUTH_CACHE_TTL)
+    return policy
+
+
+def get_tier_version(tier_id):
+    cache = get_cache()
+    version = cache.get(tier_key(tier_id))
+    if version is None:
+        version = (
+            Tier.objects.filter(pk=tier_id)
+            .values_list("policy_version", flat=True)
+            .first()
+        )
+        cache.set(tier_key(tier_id), version, settings.AUTH_CACHE_TTL)
+    return version
+
+
+def invalidate_user(user_id):
+    get_cache().delete(user_key(user_id))
+
+
+def invalidate_tier(tier_id):
+    get_cache().delete(tier_key(tier_id))
+
+
+class TokenObtainPairSerializer(BaseTokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        for claim, value in policy_claims(user).items():
+            token[claim] = value
+        return token
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        user = self.get_stateless_user(validated_token)
+        if user is not None:
+            return user
+        user = super().get_user(validated_token)
+        # tier is read by permissions on every media request
+        user.tier
+        return user
+
+    def get_stateless_user(self, validated_token):
+        user_id = validated_token.get("user_id")
+        tier_id = validated_token.get("tier_id")
+        # tokens issued before animated_thumbnails claim fall back to the
+        # database
+        if (
+            user_id is None
+            or tier_id is None
+            or "animated_thumbnails" not in validated_token
+        ):
+            return None
+        policy = get_user_policy(user_id)
+        if policy is None or policy[0] != tier_id:
+            return None
+        if get_tier_version(tier_id) != validated_token.get("policy_version"):
+            return None
+        user = get_user_model()(
+            id=user_id, username=policy[1], tier_id=tier_id, is_active=True
+        )
+        user._state.adding = False
+        user._state.db = "default"
+        tier = Tier(
+            id=tier_id,
+            tier=validated_token["tier"],
+            original_image=validated_token["original_image"],
+            animated_thumbnails=validated_token["animated_thumbnails"],
+            policy_version=validated_token["policy_version"],
+        )
+        tier._state.adding = False
+        tier._state.db = "default"
+        user.tier = tier
+        return user
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+    def authenticate_credentials(self, userid, password, request=None):
+        cache = get_cache()
+        key = "auth:basic:%s" % hashlib.sha256(
+            ("%s:%s:%s" % (settings.SECRET_KEY, userid, password)).encode()
+        ).hexdigest()
+        cached = cache.get(key)
+        if cached is not None:
+            user_id, password_hash = cached
+            user = (
+                get_user_model()
+                .objects.select_related("tier")
+                .filter(pk=user_id, is_active=True)
+                .first()
+            )
+            # changed password invalidates cached credentials
+            if user is not None and user.password == password_hash:
+                return (user, None)
+        user, auth = super().authenticate_credentials(
+            userid, password, request
+        )
+        cache.set(
+            key, (user.pk, user.password), settings.AUTH_BASIC_CACHE_TTL
+        )
+        user.tier
+        return (user, auth)
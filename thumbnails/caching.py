@@ -0,0 +1,65 @@
+import hashlib
+import math
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .authentication import get_tier_version
+from .models import ImageLink
+
+
+def get_cache():
+    return caches[settings.LIST_CACHE]
+
+
+def data_version_key(user_id):
+    return "list:version:%s" % user_id
+
+
+def get_data_version(user_id):
+    cache = get_cache()
+    key = data_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_data_version(user_id):
+    def bump():
+        get_cache().set(data_version_key(user_id), uuid.uuid4().hex, None)
+
+    bump()
+    # a list rendered by concurrent request before commit was cached under
+    # the first version
+    transaction.on_commit(bump)
+
+
+def list_key(request):
+    user = request.user
+    return "list:%s:%s:%s:%s:%s" % (
+        user.pk,
+        get_data_version(user.pk),
+        user.tier_id,
+        get_tier_version(user.tier_id),
+        hashlib.md5(request.build_absolute_uri().encode()).hexdigest(),
+    )
+
+
+def list_ttl(user):
+    ttl = settings.LIST_CACHE_TTL
+    if settings.SIGNED_MEDIA_URLS:
+        # cached signed URLs keep at least half of their lifetime
+        ttl = min(ttl, settings.SIGNED_MEDIA_URL_TTL // 2)
+    expires = ImageLink.objects.filter(
+        image__user=user, valid_until__gt=timezone.now()
+    ).aggregate(expires=Min("valid_until"))["expires"]
+    if expires is not None:
+        remaining = (expires - timezone.now()).total_seconds()
+        ttl = min(ttl, max(math.floor(remaining), 1))
+    return ttl
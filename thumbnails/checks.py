@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, register
+
+from .models import Image
+
+# invalidations have to reach every worker process
+SHARED_CACHES = ("AUTH_CACHE", "LIST_CACHE")
+
+
+@register()
+def check_shared_caches(app_configs, **kwargs):
+    errors = []
+    for setting in SHARED_CACHES:
+        if isinstance(caches[getattr(settings, setting)], LocMemCache):
+            errors.append(
+                Error(
+                    "%s uses local-memory cache, which is kept per process."
+                    % setting,
+                    hint=(
+                        "Use cache shared by worker processes, e.g. file "
+                        "based, database or Redis cache."
+                    ),
+                    id="thumbnails.E001",
+                )
+            )
+    return errors
+
+
+@register()
+def check_image_shards(app_configs, **kwargs):
+    # the highest shard prefixes 22 characters of token_urlsafe(16)
+    length = len("%s." % (settings.IMAGE_SHARDS - 1)) + 22
+    max_length = Image._meta.get_field("token").max_length
+    if settings.IMAGE_SHARDS < 1 or length > max_length:
+        return [
+            Error(
+                "IMAGE_SHARDS is %s, tokens of its shards don't fit %s "
+                "characters." % (settings.IMAGE_SHARDS, max_length),
+                hint="Use from 1 to %s shards." % 10 ** (max_length - 23),
+                id="thumbnails.E002",
+            )
+        ]
+    return []
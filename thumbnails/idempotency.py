@@ -0,0 +1,173 @@
+import functools
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from .models import IdempotencyRecord
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def request_fingerprint(request):
+    hasher = hashlib.sha256(
+        ("%s %s" % (request.method, request.path)).encode()
+    )
+    for name in sorted(request.data):
+        if hasattr(request.data, "getlist"):
+            values = request.data.getlist(name)
+        else:
+            values = [request.data[name]]
+        for value in values:
+            hasher.update(b"\0%s\0" % name.encode())
+            if hasattr(value, "chunks"):
+                for chunk in value.chunks():
+                    hasher.update(chunk)
+                value.seek(0)
+            else:
+                hasher.update(str(value).encode())
+    return hasher.hexdigest()
+
+
+def is_replay(request):
+    # retry of a finished request gets its stored response without
+    # rendering, so admission control lets it through
+    key = request.headers.get(HEADER)
+    if not key or not request.user.is_authenticated:
+        return False
+    record = IdempotencyRecord.objects.filter(
+        user=request.user,
+        key=key,
+        status_code__isnull=False,
+        created_at__gte=timezone.now()
+        - timedelta(seconds=settings.IDEMPOTENCY_TTL),
+    ).first()
+    # the same key sent with other request still renders
+    return (
+        record is not None
+        and record.fingerprint == request_fingerprint(request)
+    )
+
+
+def claim(user, key, fingerprint):
+    now = timezone.now()
+    # expired keys of the user can be used again
+    IdempotencyRecord.objects.filter(
+        user=user,
+        created_at__lt=now - timedelta(seconds=settings.IDEMPOTENCY_TTL),
+    ).delete()
+    # request of crashed worker never records its response nor refreshes
+    # its heartbeat, slow requests keep it fresh
+    IdempotencyRecord.objects.filter(
+        user=user,
+        key=key,
+        status_code__isnull=True,
+        heartbeat_at__lt=now
+        - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT),
+    ).delete()
+    try:
+        with transaction.atomic():
+            record = IdempotencyRecord.objects.create(
+                user=user, key=key, fingerprint=fingerprint
+            )
+        return record, True
+    except IntegrityError:
+        return (
+            IdempotencyRecord.objects.filter(user=user, key=key).first(),
+            False,
+        )
+
+
+@contextmanager
+def heartbeat(record):
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(settings.IDEMPOTENCY_HEARTBEAT_INTERVAL):
+                try:
+                    IdempotencyRecord.objects.filter(
+                        pk=record.pk, status_code__isnull=True
+                    ).update(heartbeat_at=timezone.now())
+                except DatabaseError:
+                    pass
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def record_response(record, func, *args, **kwargs):
+    # the record is gone when a duplicate took it over or it expired,
+    # updates and deletes of missing row do nothing
+    records = IdempotencyRecord.objects.filter(pk=record.pk)
+    try:
+        with heartbeat(record):
+            response = func(*args, **kwargs)
+    except Exception:
+        records.delete()
+        raise
+    if 200 <= response.status_code < 300:
+        records.update(
+            status_code=response.status_code, response=response.data
+        )
+    else:
+        # failed request can be sent again with the same key
+        records.delete()
+    return response
+
+
+def idempotent(func):
+    @functools.wraps(func)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return func(self, request, *args, **kwargs)
+        if len(key) > IdempotencyRecord._meta.get_field("key").max_length:
+            raise ValidationError({HEADER: "Key is too long."})
+        fingerprint = request_fingerprint(request)
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+        while True:
+            record, created = claim(request.user, key, fingerprint)
+            if created:
+                return record_response(
+                    record, func, self, request, *args, **kwargs
+                )
+            if record is not None:
+                if record.fingerprint != fingerprint:
+                    return Response(
+                        data={
+                            "detail": "Key was used with other request."
+                        },
+                        status=422,
+                    )
+                if record.status_code is not None:
+                    return Response(
+                        data=record.response,
+                        status=record.status_code,
+                        headers={REPLAYED_HEADER: "true"},
+                    )
+            if time.monotonic() >= deadline:
+                return Response(
+                    data={"detail": "Request with the key is in progress."},
+                    status=409,
+                    headers={"Retry-After": 1},
+                )
+            # first request is still rendering thumbnails
+            time.sleep(settings.IDEMPOTENCY_POLL_INTERVAL)
+
+    return wrapper
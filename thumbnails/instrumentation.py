@@ -0,0 +1,333 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+_current = ContextVar("thumbnails_metrics", default=None)
+_flush_lock = threading.Lock()
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.view = None
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, phase, seconds, size=0):
+        count, total, total_size = self.phases.get(phase, (0, 0, 0))
+        self.phases[phase] = (count + 1, total + seconds, total_size + size)
+
+    def server_timing(self, total):
+        entries = []
+        for phase, (count, seconds, size) in self.phases.items():
+            desc = "%s ops" % count
+            if size:
+                desc += ", %s B" % size
+            entries.append(
+                '%s;dur=%.2f;desc="%s"' % (phase, seconds * 1000, desc)
+            )
+        entries.append("total;dur=%.2f" % (total * 1000))
+        return ", ".join(entries)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def state(self):
+        with self.lock:
+            return {
+                "histograms": [
+                    [
+                        name,
+                        labels,
+                        histogram.counts,
+                        histogram.count,
+                        histogram.sum,
+                    ]
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+                "counters": [
+                    [name, labels, value]
+                    for (name, labels), value in self.counters.items()
+                ],
+            }
+
+    def merge(self, state):
+        with self.lock:
+            for name, labels, counts, count, total in state["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.counts = [
+                    own + other
+                    for own, other in zip(histogram.counts, counts)
+                ]
+                histogram.count += count
+                histogram.sum += total
+            for name, labels, value in state["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.histograms})
+            for name in names:
+                lines.append("# TYPE %s histogram" % name)
+                for (hist_name, labels), histogram in sorted(
+                    self.histograms.items()
+                ):
+                    if hist_name != name:
+                        continue
+                    for bound, count in zip(
+                        histogram.buckets, histogram.counts
+                    ):
+                        lines.append(
+                            "%s_bucket%s %s"
+                            % (name, format_labels(labels, le=bound), count)
+                        )
+                    lines.append(
+                        "%s_bucket%s %s"
+                        % (
+                            name,
+                            format_labels(labels, le="+Inf"),
+                            histogram.count,
+                        )
+                    )
+                    lines.append(
+                        "%s_sum%s %s"
+                        % (name, format_labels(labels), histogram.sum)
+                    )
+                    lines.append(
+                        "%s_count%s %s"
+                        % (name, format_labels(labels), histogram.count)
+                    )
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append("# TYPE %s counter" % name)
+                for (counter_name, labels), value in sorted(
+                    self.counters.items()
+                ):
+                    if counter_name == name:
+                        lines.append(
+                            "%s%s %s" % (name, format_labels(labels), value)
+                        )
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace('"', '\\"'))
+        for key, value in labels
+    )
+
+
+registry = Registry()
+
+
+def flush_metrics():
+    # every worker process keeps its totals in METRICS_DIR, /metrics of
+    # any of them sums all files
+    directory = settings.METRICS_DIR
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    with _flush_lock:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, suffix=".tmp", delete=False
+        ) as file:
+            json.dump(registry.state(), file)
+        os.replace(
+            file.name, os.path.join(directory, "%s.json" % os.getpid())
+        )
+    return None
+
+
+def collect_metrics():
+    directory = settings.METRICS_DIR
+    if not directory:
+        return registry.render()
+    flush_metrics()
+    merged = Registry()
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as file:
+                merged.merge(json.load(file))
+        except (OSError, ValueError):
+            continue
+    return merged.render()
+
+
+def clear_metrics_dir():
+    # totals of workers of the previous server run
+    directory = settings.METRICS_DIR
+    if not directory or not os.path.isdir(directory):
+        return None
+    for name in os.listdir(directory):
+        if name.endswith((".json", ".tmp")):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return None
+
+
+def record(phase, seconds, size=0):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(phase, seconds, size)
+
+
+@contextmanager
+def timer(phase, size=0):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started, size)
+
+
+def sql_wrapper(execute, sql, params, many, context):
+    if _current.get() is None:
+        return execute(sql, params, many, context)
+    with timer("sql"):
+        return execute(sql, params, many, context)
+
+
+def install_sql_wrapper(sender, connection, **kwargs):
+    if sql_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(sql_wrapper)
+
+
+class InstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(metrics, response)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(metrics, response)
+
+    def finish(self, metrics, response):
+        total = time.perf_counter() - metrics.started
+        view = metrics.view or "unresolved"
+        registry.observe(
+            "thumbnails_request_duration_seconds", {"view": view}, total
+        )
+        for phase, (count, seconds, size) in metrics.phases.items():
+            labels = {"view": view, "phase": phase}
+            registry.observe(
+                "thumbnails_phase_duration_seconds", labels, seconds
+            )
+            registry.inc("thumbnails_phase_operations_total", labels, count)
+            if size:
+                registry.inc("thumbnails_phase_bytes_total", labels, size)
+        flush_metrics()
+        if getattr(settings, "SERVER_TIMING", False):
+            response["Server-Timing"] = metrics.server_timing(total)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = _current.get()
+        if metrics is not None and request.resolver_match:
+            metrics.view = request.resolver_match.url_name
+        return None
+
+
+def metrics_view(request):
+    # timings of internals are shown to scrapers on allowed addresses and
+    # to staff
+    if not (
+        request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+        or request.user.is_staff
+    ):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        collect_metrics(), content_type="text/plain; version=0.0.4"
+    )
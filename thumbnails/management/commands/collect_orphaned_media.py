@@ -0,0 +1,147 @@
+import heapq
+import posixpath
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models.functions import Collate
+from django.utils import timezone
+
+from thumbnails.models import Image, Thumbnail
+
+
+def storage_names(storage, path=""):
+    directories, files = storage.listdir(path)
+    # directories are ordered as "name/" so the walk yields paths in the
+    # same order as a bytewise sort of the full names
+    entries = sorted(
+        [(name + "/", True) for name in directories]
+        + [(name, False) for name in files]
+    )
+    for name, is_directory in entries:
+        if is_directory:
+            yield from storage_names(storage, posixpath.join(path, name))
+        else:
+            yield posixpath.join(path, name)
+
+
+# bytewise collations, so database and python agree on the order of names
+COLLATIONS = {"postgresql": "C", "sqlite": "BINARY"}
+
+
+def referenced_names(chunk_size):
+    collation = COLLATIONS.get(connection.vendor)
+    streams = []
+    # files of soft deleted images are removed by purge_deleted_images
+    for model, field in ((Image, "image"), (Thumbnail, "thumbnail")):
+        ordering = Collate(field, collation) if collation else field
+        streams.append(
+            model._base_manager.exclude(**{field: ""})
+            .exclude(**{"%s__isnull" % field: True})
+            .order_by(ordering)
+            .values_list(field, flat=True)
+            .iterator(chunk_size=chunk_size)
+        )
+    return heapq.merge(*streams)
+
+
+def orphaned_names(stored, referenced):
+    referenced = iter(referenced)
+    reference = next(referenced, None)
+    for name in stored:
+        while reference is not None and reference < name:
+            reference = next(referenced, None)
+        if reference != name:
+            yield name
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(self.next_at, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+        return None
+
+
+class Command(BaseCommand):
+    help = "Removes media files which are not referenced by any image"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=3600,
+            help="seconds, younger files may belong to pending uploads",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="maximum deletions per second, 0 means unlimited",
+        )
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        storage = default_storage
+        limiter = RateLimiter(options["rate"])
+        min_modified = timezone.now() - timedelta(
+            seconds=options["min_age"]
+        )
+        stats = {"scanned": 0, "orphaned": 0, "deleted": 0, "bytes": 0}
+        lock = threading.Lock()
+
+        def scanned():
+            for name in storage_names(storage):
+                stats["scanned"] += 1
+                yield name
+
+        def delete(name):
+            limiter.wait()
+            size = storage.size(name)
+            storage.delete(name)
+            with lock:
+                stats["deleted"] += 1
+                stats["bytes"] += size
+
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            pending = set()
+            for name in orphaned_names(
+                scanned(), referenced_names(options["chunk_size"])
+            ):
+                if storage.get_modified_time(name) > min_modified:
+                    continue
+                stats["orphaned"] += 1
+                if options["dry_run"]:
+                    self.stdout.write(name)
+                    continue
+                pending.add(executor.submit(delete, name))
+                # keep the queue bounded for huge listings
+                if len(pending) >= options["chunk_size"]:
+                    done, pending = wait(pending)
+                    for future in done:
+                        future.result()
+            for future in pending:
+                future.result()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Scanned %(scanned)d files, found %(orphaned)d orphaned, "
+                "deleted %(deleted)d (%(bytes)d bytes)" % stats
+            )
+        )
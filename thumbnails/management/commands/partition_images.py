@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from thumbnails.partitioning import partition_tables
+
+
+class Command(BaseCommand):
+    help = (
+        "Turns tables of images, thumbnails and links into Postgres tables "
+        "partitioned by shard"
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning needs PostgreSQL")
+        with transaction.atomic():
+            partitioned = partition_tables(connection, settings.IMAGE_SHARDS)
+        for table in partitioned:
+            self.stdout.write("Partitioned %s" % table)
+        self.stdout.write(
+            self.style.SUCCESS("Partitioned %d tables" % len(partitioned))
+        )
@@ -0,0 +1,73 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from thumbnails.models import Image, UploadSession, purge_image_batch
+from thumbnails.throttling import prune_render_buckets
+from thumbnails.uploads import discard, remove_stale_files
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes soft deleted images with their thumbnails and files, "
+        "expired upload sessions and idle render buckets"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=0,
+            help="seconds since image was deleted",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="seconds between batches, spreads load on database",
+        )
+
+    def handle(self, *args, **options):
+        queryset = Image.all_objects.filter(
+            deleted_at__lte=timezone.now()
+            - timedelta(seconds=options["min_age"])
+        ).order_by("shard", "pk")
+        purged = 0
+        while True:
+            # batches of one shard touch one partition of each table
+            images = list(
+                queryset.values_list("pk", "shard")[: options["batch_size"]]
+            )
+            if not images:
+                break
+            purged += purge_image_batch(images, options["batch_size"])
+            self.stdout.write("Purged %d images" % purged)
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        self.stdout.write(self.style.SUCCESS("Purged %d images" % purged))
+        removed = self.purge_upload_sessions()
+        self.stdout.write(
+            self.style.SUCCESS("Removed %d upload sessions" % removed)
+        )
+        pruned = prune_render_buckets()
+        self.stdout.write(
+            self.style.SUCCESS("Removed %d idle render buckets" % pruned)
+        )
+
+    def purge_upload_sessions(self):
+        # abandoned sessions are never accessed again
+        sessions = UploadSession.objects.filter(
+            created_at__lt=timezone.now()
+            - timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+        )
+        removed = 0
+        for session in sessions.iterator():
+            discard(session)
+            session.delete()
+            removed += 1
+        tokens = set(UploadSession.objects.values_list("token", flat=True))
+        return removed + remove_stale_files(tokens)
@@ -0,0 +1,173 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from thumbnails.models import Image, RegenerationCheckpoint
+
+
+def init_worker():
+    import django
+
+    # no-op for forked workers, spawned ones start with empty app registry
+    django.setup()
+
+
+def regenerate(ids, heights):
+    processed, failed = 0, []
+    images = Image.objects.filter(pk__in=ids).select_related("user__tier")
+    for image in images:
+        try:
+            with transaction.atomic():
+                if heights:
+                    # other sizes are kept, only deleted and missing ones
+                    # are rendered
+                    image.delete_thumbnails(heights)
+                    image.update_thumbnails_after_changes()
+                else:
+                    image.update_thumbnails()
+            processed += 1
+        except Exception as exc:
+            failed.append((image.pk, repr(exc)))
+    return processed, failed
+
+
+class Command(BaseCommand):
+    help = "Regenerates thumbnails of images in resumable chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--name",
+            default="default",
+            help="checkpoint name, a run with the same name is resumed",
+        )
+        parser.add_argument("--reset", action="store_true")
+        parser.add_argument("--tier", help="tier name, e.g. PREMIUM")
+        parser.add_argument("--user", help="username")
+        parser.add_argument("--since", help="ISO datetime of upload")
+        parser.add_argument("--until", help="ISO datetime of upload")
+        parser.add_argument(
+            "--height",
+            type=int,
+            action="append",
+            help="regenerate only thumbnails of this height",
+        )
+        parser.add_argument("--chunk-size", type=int, default=100)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="size of process pool, 0 renders in this process",
+        )
+
+    def get_filters(self, options):
+        return {
+            key: options[key]
+            for key in ("tier", "user", "since", "until", "height")
+            if options[key]
+        }
+
+    def get_queryset(self, filters):
+        queryset = Image.objects.all()
+        if "tier" in filters:
+            queryset = queryset.filter(user__tier__tier=filters["tier"])
+        if "user" in filters:
+            queryset = queryset.filter(user__username=filters["user"])
+        for key, lookup in (("since", "gte"), ("until", "lt")):
+            if key in filters:
+                value = parse_datetime(filters[key])
+                if value is None:
+                    raise CommandError("Wrong datetime: %s" % filters[key])
+                queryset = queryset.filter(
+                    **{"created_at__%s" % lookup: value}
+                )
+        if "height" in filters:
+            # sizes of the tier, thumbnails of a new size don't exist yet
+            queryset = queryset.filter(
+                user__tier__sizes__height__in=filters["height"]
+            ).distinct()
+        return queryset
+
+    def handle(self, *args, **options):
+        filters = self.get_filters(options)
+        checkpoint, created = RegenerationCheckpoint.objects.get_or_create(
+            name=options["name"], defaults={"filters": filters}
+        )
+        if options["reset"] or checkpoint.finished_at:
+            checkpoint.last_id = checkpoint.processed = checkpoint.failed = 0
+            checkpoint.finished_at = None
+            checkpoint.filters = filters
+            checkpoint.save()
+        elif not created and filters and checkpoint.filters != filters:
+            raise CommandError(
+                "Checkpoint %s was started with filters %s, use --reset"
+                % (checkpoint.name, checkpoint.filters)
+            )
+        filters = checkpoint.filters
+        if checkpoint.last_id:
+            self.stdout.write(
+                "Resuming %s after image %s"
+                % (checkpoint.name, checkpoint.last_id)
+            )
+
+        queryset = self.get_queryset(filters).order_by("pk")
+        remaining = queryset.filter(pk__gt=checkpoint.last_id).count()
+        workers = options["workers"]
+        executor = None
+        if workers:
+            connections.close_all()
+            executor = ProcessPoolExecutor(workers, initializer=init_worker)
+
+        started = time.monotonic()
+        done = 0
+        try:
+            while True:
+                ids = list(
+                    queryset.filter(pk__gt=checkpoint.last_id).values_list(
+                        "pk", flat=True
+                    )[: options["chunk_size"]]
+                )
+                if not ids:
+                    break
+                if executor:
+                    batches = [
+                        ids[index::workers] for index in range(workers)
+                    ]
+                    results = executor.map(
+                        regenerate,
+                        [batch for batch in batches if batch],
+                        [filters.get("height")] * workers,
+                    )
+                else:
+                    results = [regenerate(ids, filters.get("height"))]
+                for processed, failed in results:
+                    checkpoint.processed += processed
+                    checkpoint.failed += len(failed)
+                    for image_id, error in failed:
+                        self.stderr.write("Image %s: %s" % (image_id, error))
+                checkpoint.last_id = ids[-1]
+                checkpoint.save()
+
+                done += len(ids)
+                elapsed = time.monotonic() - started
+                rate = done / elapsed if elapsed else 0
+                eta = (remaining - done) / rate if rate else 0
+                self.stdout.write(
+                    "%d/%d images, %.1f images/s, ETA %ds"
+                    % (done, remaining, rate, max(eta, 0))
+                )
+        finally:
+            if executor:
+                executor.shutdown()
+
+        checkpoint.finished_at = timezone.now()
+        checkpoint.save()
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Regenerated %d images, %d failed"
+                % (checkpoint.processed, checkpoint.failed)
+            )
+        )
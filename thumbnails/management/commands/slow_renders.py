@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from thumbnails.profiling import read_slow_renders
+
+
+class Command(BaseCommand):
+    help = "Aggregates slow render log into the top offending inputs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--log", default=str(settings.THUMBNAIL_SLOW_RENDER_LOG)
+        )
+        parser.add_argument("--top", type=int, default=10)
+        parser.add_argument(
+            "--by",
+            choices=["max", "total", "count"],
+            default="max",
+            help="order inputs by the slowest render, summed time or count",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            entries = list(read_slow_renders(options["log"]))
+        except FileNotFoundError:
+            raise CommandError("Log %s does not exist" % options["log"])
+
+        inputs = {}
+        for entry in entries:
+            item = inputs.setdefault(
+                entry["name"],
+                {
+                    "name": entry["name"],
+                    "image": entry["image"],
+                    "source": entry["source"],
+                    "count": 0,
+                    "total": 0,
+                    "max": 0,
+                    "profile": None,
+                    "slowest_step": None,
+                },
+            )
+            item["count"] += 1
+            item["total"] += entry["total"]
+            if entry["total"] >= item["max"]:
+                item["max"] = entry["total"]
+                item["profile"] = entry.get("profile")
+                item["slowest_step"] = slowest_step(entry)
+
+        ranking = sorted(
+            inputs.values(), key=lambda item: item[options["by"]], reverse=True
+        )
+        self.stdout.write(
+            "%d slow renders of %d inputs" % (len(entries), len(inputs))
+        )
+        for item in ranking[: options["top"]]:
+            source = item["source"]
+            self.stdout.write(
+                "%s (image %s) %sx%s %s %s frames=%s: count=%d max=%.3fs "
+                "total=%.3fs slowest=%s%s"
+                % (
+                    item["name"],
+                    item["image"],
+                    source.get("width"),
+                    source.get("height"),
+                    source.get("mode"),
+                    source.get("format"),
+                    source.get("frames"),
+                    item["count"],
+                    item["max"],
+                    item["total"],
+                    item["slowest_step"],
+                    " profile=%s" % item["profile"] if item["profile"] else "",
+                )
+            )
+
+
+def slowest_step(entry):
+    steps = [(seconds, phase) for phase, seconds in entry["phases"].items()]
+    for render in entry["renders"]:
+        for phase, seconds in render.items():
+            if phase not in ("height", "density", "bytes"):
+                steps.append(
+                    (
+                        seconds,
+                        "%s@%sx%s"
+                        % (phase, render["height"], render["density"]),
+                    )
+                )
+    if not steps:
+        return None
+    seconds, phase = max(steps)
+    return "%s(%.3fs)" % (phase, seconds)
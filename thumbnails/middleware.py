@@ -3,6 +3,7 @@ import base64
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
+from .instrumentation import timer
 from .utils import image_format_from_json
 
 
@@ -26,7 +27,8 @@ class DecodeBase64Middleware:
             request[0].data["image"]=image
             return None
         try:
-            to_file = base64.b64decode(image)
+            with timer("base64_decode", len(image)):
+                to_file = base64.b64decode(image)
         except OSError:
             return None
 
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-19 07:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnail',
+            name='density',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='thumbnail',
+            name='width',
+            field=models.IntegerField(null=True),
+        ),
+    ]
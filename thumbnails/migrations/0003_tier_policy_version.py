@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-19 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0002_thumbnail_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tier',
+            name='policy_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
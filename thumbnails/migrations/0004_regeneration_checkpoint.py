@@ -0,0 +1,32 @@
+# Generated by Django 4.2.16 on 2026-10-19 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0003_tier_policy_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegenerationCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('filters', models.JSONField(default=dict)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.16 on 2026-10-19 08:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0005_upload_session'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='token',
+            field=models.CharField(db_index=True, max_length=25, null=True, verbose_name='token'),
+        ),
+        migrations.AlterField(
+            model_name='imagelink',
+            name='token',
+            field=models.CharField(db_index=True, max_length=25, null=True, verbose_name='token'),
+        ),
+        migrations.AlterField(
+            model_name='imagelink',
+            name='valid_until',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='token',
+            field=models.CharField(db_index=True, max_length=25, null=True, verbose_name='token'),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='token',
+            field=models.CharField(db_index=True, max_length=25, null=True, verbose_name='token'),
+        ),
+    ]
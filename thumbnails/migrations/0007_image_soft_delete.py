@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-19 08:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0006_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='deleted_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-19 08:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0007_image_soft_delete'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tier',
+            name='animated_thumbnails',
+            field=models.BooleanField(default=False),
+        ),
+    ]
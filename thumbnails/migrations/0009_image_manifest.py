@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-19 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0008_animated_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='manifest',
+            field=models.JSONField(default=dict),
+        ),
+    ]
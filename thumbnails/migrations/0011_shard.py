@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def fill_shards(apps, schema_editor):
+    Image = apps.get_model("thumbnails", "Image")
+    Image.objects.update(shard=F("user_id") % settings.IMAGE_SHARDS)
+    image_shard = Subquery(
+        Image.objects.filter(pk=OuterRef("image_id")).values("shard")[:1]
+    )
+    for name in ("Thumbnail", "ImageLink"):
+        apps.get_model("thumbnails", name).objects.update(shard=image_shard)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0010_idempotency_record'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='shard',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='imagelink',
+            name='shard',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='thumbnail',
+            name='shard',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.RunPython(fill_shards, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='image',
+            name='shard',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='imagelink',
+            name='shard',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='shard',
+            field=models.PositiveSmallIntegerField(),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.db import migrations
+
+from thumbnails.partitioning import partition_tables
+
+
+def partition(apps, schema_editor):
+    # opt-in, partitioned tables are not turned back into plain ones
+    connection = schema_editor.connection
+    if settings.IMAGE_PARTITIONING and connection.vendor == "postgresql":
+        partition_tables(connection, settings.IMAGE_SHARDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0011_shard'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.16 on 2026-10-19 09:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thumbnails', '0013_render_bucket'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='image', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -1,15 +1,27 @@
 import datetime
+import functools
+import hashlib
+import math
+import os
 import secrets
 from io import BytesIO
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core import files
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.storage import default_storage
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.dispatch import Signal
 from django.utils import timezone
+from PIL import ExifTags, ImageCms
 from PIL import Image as Img
 
+from .profiling import RenderProfile
+from .utils import delete_files, open_source, save_buffer
+
 
 class Tier(models.Model):
     class Tiers(models.TextChoices):
@@ -21,10 +33,18 @@ class Tier(models.Model):
         max_length=255, default=Tiers.BASIC, choices=Tiers.choices
     )
     original_image = models.BooleanField(default=False)
+    # animated inputs get animated thumbnails, otherwise the first frame
+    animated_thumbnails = models.BooleanField(default=False)
+    policy_version = models.PositiveIntegerField(default=1)
 
     def __str__(self):
         return self.tier
 
+    def delete(self, *args, **kwargs):
+        # cascade through users would collect every image row by row
+        soft_delete_images(Image.all_objects.filter(user__tier=self))
+        return super().delete(*args, **kwargs)
+
 
 class Size(models.Model):
     tier = models.ManyToManyField(Tier, related_name="sizes")
@@ -40,9 +60,18 @@ class User(AbstractUser):
         validators=[MaxValueValidator(30000), MinValueValidator(300)],
     )
 
+    def delete(self, *args, **kwargs):
+        shard = shard_for_user(self.pk)
+        soft_delete_images(
+            Image.all_objects.filter(user=self, shard=shard), shard=shard
+        )
+        return super().delete(*args, **kwargs)
+
 
 class TokenMixin(models.Model):
-    token = models.CharField(max_length=25, null=True, verbose_name="token")
+    token = models.CharField(
+        max_length=25, null=True, db_index=True, verbose_name="token"
+    )
 
     class Meta:
         abstract = True
@@ -55,22 +84,135 @@ class TokenMixin(models.Model):
         return self.save()
 
 
-class Image(TokenMixin):
+def shard_for_user(user_id):
+    return user_id % settings.IMAGE_SHARDS
+
+
+def shard_from_token(token):
+    prefix, separator, rest = (token or "").partition(".")
+    if separator and prefix.isdigit():
+        return int(prefix)
+    return None
+
+
+class ShardMixin(models.Model):
+    # partition key when IMAGE_PARTITIONING is enabled, rows of one user
+    # are kept in one partition
+    shard = models.PositiveSmallIntegerField()
+
+    class Meta:
+        abstract = True
+
+    # subclasses define get_shard()
+
+    def generate_token(self):
+        if self.shard is None:
+            self.shard = self.get_shard()
+        # shard hint lets lookups by token scan only one partition
+        return "%s.%s" % (self.shard, super().generate_token())
+
+    def save(self, *args, **kwargs):
+        if self.shard is None:
+            self.shard = self.get_shard()
+        return super().save(*args, **kwargs)
+
+
+ORIENTATIONS = {
+    2: Img.Transpose.FLIP_LEFT_RIGHT,
+    3: Img.Transpose.ROTATE_180,
+    4: Img.Transpose.FLIP_TOP_BOTTOM,
+    5: Img.Transpose.TRANSPOSE,
+    6: Img.Transpose.ROTATE_270,
+    7: Img.Transpose.TRANSVERSE,
+    8: Img.Transpose.ROTATE_90,
+}
+
+# encoder options of animations, other metadata is not copied to thumbnails
+KEPT_INFO = ("transparency", "background", "duration", "loop")
+
+
+@functools.lru_cache(maxsize=16)
+def get_srgb_transform(icc_profile, mode):
+    output_mode = "RGBA" if mode == "RGBA" else "RGB"
+    return ImageCms.buildTransform(
+        ImageCms.ImageCmsProfile(BytesIO(icc_profile)),
+        ImageCms.createProfile("sRGB"),
+        mode,
+        output_mode,
+    )
+
+
+def prepare_frame(img, transpose, icc_profile, in_place=True):
+    # same result as ImageOps.exif_transpose, which copies upright images
+    if transpose is not None:
+        img = img.transpose(transpose)
+        in_place = True
+    if icc_profile and img.mode in ("RGB", "RGBA", "CMYK"):
+        transform = get_srgb_transform(icc_profile, img.mode)
+        if in_place and transform.output_mode == img.mode:
+            ImageCms.applyTransform(img, transform, inPlace=True)
+        else:
+            img = ImageCms.applyTransform(img, transform)
+    img.info = {key: img.info[key] for key in KEPT_INFO if key in img.info}
+    return img
+
+
+# soft_delete updates the row without post_save
+image_soft_deleted = Signal()
+
+
+class ActiveImageManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
+class Image(ShardMixin, TokenMixin):
     class Formats:
         ALLOWED = {
             "png": "PNG",
             "jpg": "JPEG",
             "jpeg": "JPEG",
+            "gif": "GIF",
+            "webp": "WEBP",
         }
 
     image = models.ImageField()
+    # soft deleted images of deleted users have no user
     user = models.ForeignKey(
-        User, on_delete=models.CASCADE, related_name="image"
+        User, on_delete=models.CASCADE, null=True, related_name="image"
     )
+    created_at = models.DateTimeField(
+        auto_now_add=True, null=True, db_index=True
+    )
+    # soft deleted images wait for purge_deleted_images
+    deleted_at = models.DateTimeField(null=True, db_index=True)
+    # thumbnails by height, valid while "policy" matches tier of the user
+    manifest = models.JSONField(default=dict)
+
+    objects = ActiveImageManager()
+    all_objects = models.Manager()
+
+    def get_shard(self):
+        return shard_for_user(self.user_id)
+
+    def soft_delete(self):
+        with transaction.atomic():
+            self.deleted_at = timezone.now()
+            self.token = None
+            self.manifest = {}
+            Image.all_objects.filter(pk=self.pk, shard=self.shard).update(
+                deleted_at=self.deleted_at, token=None, manifest={}
+            )
+            # media of the image is not reachable from now on
+            self.thumbnails.filter(shard=self.shard).update(token=None)
+            self.expiring_link.filter(shard=self.shard).update(token=None)
+        image_soft_deleted.send(sender=Image, instance=self)
+        return None
 
     def generate_image_link(self):
         image_link = ImageLink.objects.create(
             image=self,
+            shard=self.shard,
             token=self.generate_token(),
             valid_until=(
                 timezone.now()
@@ -79,10 +221,87 @@ class Image(TokenMixin):
         )
         return image_link
 
-    def check_thumbnails(self):
-        tier_sizes_thn_set = set(
-            [obj.height for obj in self.user.tier.sizes.all()]
+    @staticmethod
+    def manifest_policy(tier):
+        return [tier.pk, tier.policy_version] if tier else None
+
+    def manifest_is_current(self, tier=None):
+        if tier is None:
+            tier = self.user.tier
+        return (
+            tier is not None
+            and self.manifest.get("policy") == self.manifest_policy(tier)
+        )
+
+    def manifest_heights(self, tier):
+        if not self.manifest_is_current(tier):
+            return None
+        return [int(height) for height in self.manifest["heights"]]
+
+    def manifest_thumbnails(self, tier):
+        if not self.manifest_is_current(tier):
+            return None
+        return [
+            Thumbnail(
+                image=self,
+                height=int(height),
+                density=entry["density"],
+                width=entry["width"],
+                token=entry["token"],
+                thumbnail=entry["name"],
+            )
+            for height, entries in self.manifest["heights"].items()
+            for entry in entries
+        ]
+
+    def update_manifest(self, rendered=()):
+        known = {
+            entry["token"]: entry
+            for entries in self.manifest.get("heights", {}).values()
+            for entry in entries
+        }
+        for thumbnail in rendered:
+            known[thumbnail.token] = {
+                "bytes": thumbnail.encoded_bytes,
+                "sha256": thumbnail.sha256,
+            }
+        heights = {}
+        # rows are read again, deletes of thumbnails may be prefetched
+        for thumbnail in Thumbnail.objects.filter(
+            image=self, shard=self.shard
+        ).order_by(
+            "height", "density"
+        ):
+            entry = known.get(thumbnail.token, {})
+            heights.setdefault(str(thumbnail.height), []).append(
+                {
+                    "token": thumbnail.token,
+                    "density": thumbnail.density,
+                    "width": thumbnail.width,
+                    "name": thumbnail.thumbnail.name,
+                    "bytes": entry.get("bytes"),
+                    "sha256": entry.get("sha256"),
+                }
+            )
+        self.manifest = {
+            # version read with the sizes, a concurrent change of the tier
+            # leaves the manifest stale instead of wrong
+            "policy": getattr(self, "checked_policy", None),
+            "heights": heights,
+        }
+        # lists are cached after reconciliation, no data version bump
+        Image.all_objects.filter(pk=self.pk, shard=self.shard).update(
+            manifest=self.manifest
         )
+        return self.manifest
+
+    def check_thumbnails(self):
+        tier = Tier.objects.get(pk=self.user.tier_id)
+        # rendering follows this tier, tier of the user may be built from
+        # token claims
+        self.checked_tier = tier
+        self.checked_policy = self.manifest_policy(tier)
+        tier_sizes_thn_set = set([obj.height for obj in tier.sizes.all()])
         created_sizes_thn_set = set(
             [thumbnail.height for thumbnail in self.thumbnails.all()]
         )
@@ -91,70 +310,342 @@ class Image(TokenMixin):
         return to_create, to_delete
 
     def create_thumbnails(self, to_create):
-        import sys
-
         if not to_create:
             return None
         thumbnails = []
-        for height in to_create:
-            format = self.image.url.split(".")[-1]
-            img = Img.open(self.image)
-            img.thumbnail([height, height])
-            img_io = BytesIO()
-            img.save(img_io, format=self.Formats.ALLOWED[format])
-            thn = InMemoryUploadedFile(
-                img_io,
-                "thumbnail",
-                "thumbnail.%s" % self.Formats.ALLOWED[format],
-                self.Formats.ALLOWED[format],
-                sys.getsizeof(img_io),
-                None,
+        # files are written before rows are inserted, remove them when
+        # rendering or the insert fails
+        try:
+            with RenderProfile(self) as profile, open_source(
+                self.image
+            ) as fp:
+                tier = getattr(self, "checked_tier", None) or self.user.tier
+                with profile.step("pillow_decode"):
+                    source = Img.open(fp)
+                    source.load()
+                    transpose = ORIENTATIONS.get(
+                        source.getexif().get(ExifTags.Base.Orientation)
+                    )
+                    # profile is kept for frames, info of the poster is
+                    # stripped
+                    icc_profile = source.info.get("icc_profile")
+                    animated = (
+                        getattr(source, "n_frames", 1) > 1
+                        and tier.animated_thumbnails
+                    )
+                    # frames are read from the source again, then it is
+                    # not converted in place
+                    img = prepare_frame(
+                        source, transpose, icc_profile, in_place=not animated
+                    )
+                profile.set_source(source)
+                variants = []
+                for height in to_create:
+                    rendered = set()
+                    for density in Thumbnail.Densities.ALLOWED:
+                        size = self.fit_size(img.size, height * density)
+                        # upscaling is never done, so a denser variant of a
+                        # small source would be a copy of the previous one
+                        if size in rendered:
+                            continue
+                        rendered.add(size)
+                        variants.append((height, density, size))
+                animation = None
+                if animated:
+                    animation = self.sample_frames(
+                        source,
+                        {size for _, _, size in variants},
+                        transpose,
+                        icc_profile,
+                        profile,
+                    )
+                for height, density, size in variants:
+                    thumbnails.append(
+                        self.render_thumbnail(
+                            img, size, height, density, profile, animation
+                        )
+                    )
+            return Thumbnail.objects.bulk_create(thumbnails)
+        except Exception:
+            delete_files([thumbnail.thumbnail for thumbnail in thumbnails])
+            raise
+
+    def sample_frames(self, img, sizes, transpose, icc_profile, profile):
+        # every step-th frame is kept, so at most THUMBNAIL_MAX_FRAMES
+        # frames are resized and encoded, and only one full frame is decoded
+        # at a time
+        step = math.ceil(img.n_frames / settings.THUMBNAIL_MAX_FRAMES)
+        frames = {size: [] for size in sizes}
+        durations = []
+        for index in range(img.n_frames):
+            with profile.step("pillow_decode"):
+                img.seek(index)
+            duration = img.info.get("duration", 100)
+            if index % step:
+                durations[-1] += duration
+                continue
+            durations.append(duration)
+            frame = prepare_frame(
+                img.convert("RGBA"), transpose, icc_profile
             )
-            thumbnails.append(
-                Thumbnail.objects.create(
-                    image=self,
-                    height=height,
-                    token=self.generate_token(),
-                    thumbnail=thn,
+            for size in sizes:
+                with profile.step("pillow_resize"):
+                    frames[size].append(
+                        frame if size == frame.size else frame.resize(size)
+                    )
+        img.seek(0)
+        return frames, durations
+
+    def render_thumbnail(
+        self, img, size, height, density, profile, animation=None
+    ):
+        format = self.Formats.ALLOWED[self.image.url.split(".")[-1]]
+        img_io = BytesIO()
+        if animation:
+            frames, durations = animation[0][size], animation[1]
+            with profile.step("pillow_encode", height, density):
+                frames[0].save(
+                    img_io,
+                    format=format,
+                    save_all=True,
+                    append_images=frames[1:],
+                    duration=durations,
+                    loop=img.info.get("loop", 0),
                 )
-            )
-        return thumbnails
+        else:
+            with profile.step("pillow_resize", height, density):
+                thn_img = img if size == img.size else img.resize(size)
+            with profile.step("pillow_encode", height, density):
+                thn_img.save(img_io, format=format)
+        thumbnail = Thumbnail(
+            image=self,
+            shard=self.shard,
+            height=height,
+            density=density,
+            width=size[0],
+            token=self.generate_token(),
+        )
+        # kept for the manifest, encoded bytes are not read again
+        thumbnail.encoded_bytes = img_io.tell()
+        thumbnail.sha256 = hashlib.sha256(img_io.getbuffer()).hexdigest()
+        with profile.step("storage_write", height, density, img_io.tell()):
+            save_buffer(thumbnail.thumbnail, "thumbnail.%s" % format, img_io)
+        return thumbnail
+
+    @staticmethod
+    def fit_size(size, box):
+        width, height = size
+        scale = min(box / width, box / height, 1)
+        return max(round(width * scale), 1), max(round(height * scale), 1)
 
     def delete_thumbnails(self, to_delete):
         if not to_delete:
             return None
-        return self.thumbnails.filter(height__in=to_delete).delete()
+        deleted = self.thumbnails.filter(
+            shard=self.shard, height__in=to_delete
+        ).delete()
+        # post_delete cleared the stored manifest, reconciliation of this
+        # instance must not skip the deleted sizes
+        self.manifest = dict(self.manifest, policy=None)
+        return deleted
 
     def update_thumbnails_after_changes(self):
+        # thumbnails only change with the tier policy, one row tells it
+        if self.manifest_is_current():
+            return None
         to_create, to_delete = self.check_thumbnails()
-        self.create_thumbnails(to_create)
+        thumbnails = self.create_thumbnails(to_create)
         self.delete_thumbnails(to_delete)
+        self.update_manifest(thumbnails or [])
         return None
 
     def update_thumbnails(self):
-        self.thumbnails.all().delete()
+        self.thumbnails.filter(shard=self.shard).delete()
         to_create, to_delete = self.check_thumbnails()
         thumbnails = self.create_thumbnails(to_create)
+        self.update_manifest(thumbnails or [])
         return thumbnails
 
 
-class Thumbnail(TokenMixin):
+class Thumbnail(ShardMixin, TokenMixin):
+    class Densities:
+        ALLOWED = (1, 2)
+
     image = models.ForeignKey(
         Image, on_delete=models.CASCADE, related_name="thumbnails"
     )
     height = models.IntegerField()
+    density = models.PositiveSmallIntegerField(default=1)
+    width = models.IntegerField(null=True)
     thumbnail = models.ImageField()
 
+    def get_shard(self):
+        return self.image.shard
 
-class ImageLink(TokenMixin):
-    valid_until = models.DateTimeField()
+
+class ImageLink(ShardMixin, TokenMixin):
+    valid_until = models.DateTimeField(db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     image = models.ForeignKey(
         Image, on_delete=models.CASCADE, related_name="expiring_link"
     )
 
+    def get_shard(self):
+        return self.image.shard
+
     def is_valid(self):
         if self.valid_until < timezone.now():
             self.delete()
             return False
         return True
+
+
+class RegenerationCheckpoint(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    filters = models.JSONField(default=dict)
+    last_id = models.BigIntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return self.name
+
+
+class UploadSession(TokenMixin):
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="upload_sessions"
+    )
+    # image replaced on finalize, new image is created without it
+    image = models.ForeignKey(
+        Image,
+        on_delete=models.CASCADE,
+        null=True,
+        related_name="upload_sessions",
+    )
+    filename = models.CharField(max_length=255)
+    length = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def path(self):
+        return os.path.join(settings.UPLOAD_SESSION_DIR, self.token)
+
+    def is_expired(self):
+        return self.created_at + datetime.timedelta(
+            seconds=settings.UPLOAD_SESSION_TTL
+        ) < timezone.now()
+
+
+class IdempotencyRecord(models.Model):
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="idempotency_records"
+    )
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    # response is empty while the first request is processed
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # refreshed while the first request is processed
+    heartbeat_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "key"], name="unique_idempotency_key"
+            )
+        ]
+
+
+class RenderBucket(models.Model):
+    # token bucket of RenderThrottle, shared by all workers
+    key = models.CharField(max_length=255, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.DateTimeField()
+
+
+def raw_delete(model, ids, batch_size, shards=()):
+    table = connection.ops.quote_name(model._meta.db_table)
+    # shards limit the delete to their partitions
+    shard_filter = (
+        "shard IN (%s) AND " % ", ".join(["%s"] * len(shards))
+        if shards
+        else ""
+    )
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start : start + batch_size]
+            cursor.execute(
+                "DELETE FROM %s WHERE %sid IN (%s)"
+                % (table, shard_filter, ", ".join(["%s"] * len(chunk))),
+                list(shards) + chunk,
+            )
+
+
+def purge_image_batch(images, batch_size):
+    # images are (pk, shard) pairs
+    image_ids = [pk for pk, shard in images]
+    shards = sorted({shard for pk, shard in images})
+    thumbnails = list(
+        Thumbnail.objects.filter(
+            shard__in=shards, image_id__in=image_ids
+        ).values_list("pk", "thumbnail")
+    )
+    names = [name for pk, name in thumbnails] + list(
+        Image.all_objects.filter(
+            shard__in=shards, pk__in=image_ids
+        ).values_list("image", flat=True)
+    )
+
+    def delete_names():
+        for name in names:
+            if name:
+                default_storage.delete(name)
+
+    # rows are deleted without collecting them and sending signals
+    with transaction.atomic():
+        raw_delete(
+            Thumbnail, [pk for pk, name in thumbnails], batch_size, shards
+        )
+        raw_delete(
+            ImageLink,
+            list(
+                ImageLink.objects.filter(
+                    shard__in=shards, image_id__in=image_ids
+                ).values_list("pk", flat=True)
+            ),
+            batch_size,
+            shards,
+        )
+        raw_delete(
+            UploadSession,
+            list(
+                UploadSession.objects.filter(
+                    image_id__in=image_ids
+                ).values_list("pk", flat=True)
+            ),
+            batch_size,
+        )
+        raw_delete(Image, image_ids, batch_size, shards)
+        transaction.on_commit(delete_names)
+    return len(image_ids)
+
+
+def soft_delete_images(queryset, shard=None):
+    # images of deleted users and tiers are hidden in a few statements and
+    # detached from users, purge_deleted_images removes them later
+    ids = queryset.values("pk")
+    filters = {} if shard is None else {"shard": shard}
+    with transaction.atomic():
+        Thumbnail.objects.filter(image__in=ids, **filters).update(token=None)
+        ImageLink.objects.filter(image__in=ids, **filters).update(token=None)
+        return queryset.update(
+            deleted_at=Coalesce("deleted_at", Value(timezone.now())),
+            token=None,
+            manifest={},
+            user=None,
+        )
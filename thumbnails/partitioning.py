@@ -0,0 +1,90 @@
+PARTITIONED_TABLES = (
+    "thumbnails_image",
+    "thumbnails_thumbnail",
+    "thumbnails_imagelink",
+)
+
+
+def is_partitioned(connection, table):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table "
+            "WHERE partrelid = %s::regclass",
+            [table],
+        )
+        return cursor.fetchone() is not None
+
+
+def partition_table(cursor, quote_name, table, shards):
+    old = "%s_unpartitioned" % table
+    sequence = "%s_id_seq" % table
+    # primary key is the only unique index of the tables, the rest is
+    # created again on the partitioned table
+    cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE tablename = %s "
+        "AND indexdef NOT LIKE 'CREATE UNIQUE %%'",
+        [table],
+    )
+    indexes = [row[0] for row in cursor.fetchall()]
+    # unique key of partitioned table has to contain shard, so foreign keys
+    # referencing images can't exist, deletes are cascaded by Django
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'f' "
+        "AND NOT confrelid::regclass::text = ANY(%s)",
+        [table, list(PARTITIONED_TABLES)],
+    )
+    foreign_keys = cursor.fetchall()
+    cursor.execute(
+        "ALTER TABLE %s RENAME TO %s" % (quote_name(table), quote_name(old))
+    )
+    cursor.execute(
+        "CREATE TABLE %s (LIKE %s) PARTITION BY LIST (shard)"
+        % (quote_name(table), quote_name(old))
+    )
+    for shard in range(shards):
+        cursor.execute(
+            "CREATE TABLE %s PARTITION OF %s FOR VALUES IN (%s)"
+            % (quote_name("%s_p%s" % (table, shard)), quote_name(table), shard)
+        )
+    cursor.execute(
+        "INSERT INTO %s SELECT * FROM %s"
+        % (quote_name(table), quote_name(old))
+    )
+    cursor.execute("DROP TABLE %s CASCADE" % quote_name(old))
+    cursor.execute(
+        "ALTER TABLE %s ADD PRIMARY KEY (id, shard)" % quote_name(table)
+    )
+    cursor.execute(
+        "CREATE SEQUENCE %s OWNED BY %s.id"
+        % (quote_name(sequence), quote_name(table))
+    )
+    cursor.execute(
+        "SELECT setval(%%s, COALESCE(MAX(id), 0) + 1, false) FROM %s"
+        % quote_name(table),
+        [sequence],
+    )
+    cursor.execute(
+        "ALTER TABLE %s ALTER COLUMN id SET DEFAULT nextval(%%s::regclass)"
+        % quote_name(table),
+        [sequence],
+    )
+    for index in indexes:
+        cursor.execute(index)
+    for name, definition in foreign_keys:
+        cursor.execute(
+            "ALTER TABLE %s ADD CONSTRAINT %s %s"
+            % (quote_name(table), quote_name(name), definition)
+        )
+
+
+def partition_tables(connection, shards):
+    # rows are copied, on big tables run it in a maintenance window
+    partitioned = []
+    with connection.cursor() as cursor:
+        for table in PARTITIONED_TABLES:
+            if is_partitioned(connection, table):
+                continue
+            partition_table(cursor, connection.ops.quote_name, table, shards)
+            partitioned.append(table)
+    return partitioned
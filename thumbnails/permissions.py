@@ -1,14 +1,18 @@
 from rest_framework.permissions import BasePermission
 
-from .models import Tier, Thumbnail
+from .models import Tier
 
 
 class ThumbnailPermission(BasePermission):
     def has_object_permission(self, request, view, obj):
         return obj.image.user == request.user
     def has_permission(self, request, view):
-        obj = Thumbnail.objects.filter(token=view.kwargs.get("token")).first()
-        return obj.height in [size.height for size in request.user.tier.sizes.all()]
+        # raises 404 for unknown token
+        obj = view.get_object()
+        heights = obj.image.manifest_heights(request.user.tier)
+        if heights is None:
+            heights = [size.height for size in request.user.tier.sizes.all()]
+        return obj.height in heights
 
 
 class ImagePermission(BasePermission):
@@ -0,0 +1,109 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import timezone
+
+from .instrumentation import timer
+
+_log_lock = threading.Lock()
+
+
+class RenderProfile:
+    def __init__(self, image):
+        self.image = image
+        self.enabled = getattr(settings, "THUMBNAIL_PROFILING", False)
+        self.profiler = None
+        self.source = {}
+        self.phases = {}
+        self.renders = []
+
+    def __enter__(self):
+        if self.enabled:
+            if getattr(settings, "THUMBNAIL_PROFILE_DIR", None):
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.enabled:
+            return False
+        total = time.perf_counter() - self.started
+        if self.profiler:
+            self.profiler.disable()
+        if total >= settings.THUMBNAIL_SLOW_RENDER_THRESHOLD:
+            self.write(total, failed=exc_type is not None)
+        return False
+
+    def set_source(self, img):
+        if self.enabled:
+            self.source = {
+                "width": img.width,
+                "height": img.height,
+                "mode": img.mode,
+                "format": img.format,
+                "frames": getattr(img, "n_frames", 1),
+            }
+
+    @contextmanager
+    def step(self, phase, height=None, density=None, size=0):
+        started = time.perf_counter()
+        with timer(phase, size):
+            yield
+        if not self.enabled:
+            return
+        seconds = time.perf_counter() - started
+        if height is None:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+            return
+        for render in self.renders:
+            if (render["height"], render["density"]) == (height, density):
+                break
+        else:
+            render = {"height": height, "density": density}
+            self.renders.append(render)
+        render[phase] = render.get(phase, 0) + seconds
+        if size:
+            render["bytes"] = size
+
+    def write(self, total, failed=False):
+        entry = {
+            "created_at": timezone.now().isoformat(),
+            "image": self.image.pk,
+            "name": self.image.image.name,
+            "user": self.image.user_id,
+            "total": total,
+            "failed": failed,
+            "source": self.source,
+            "phases": self.phases,
+            "renders": self.renders,
+        }
+        if self.profiler:
+            os.makedirs(settings.THUMBNAIL_PROFILE_DIR, exist_ok=True)
+            entry["profile"] = os.path.join(
+                settings.THUMBNAIL_PROFILE_DIR,
+                "render-%s-%s.prof"
+                % (self.image.pk, int(time.time() * 1000)),
+            )
+            self.profiler.dump_stats(entry["profile"])
+        line = json.dumps(entry) + "\n"
+        with _log_lock:
+            with open(settings.THUMBNAIL_SLOW_RENDER_LOG, "a") as file:
+                file.write(line)
+
+
+def read_slow_renders(path):
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
@@ -0,0 +1,101 @@
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+
+STICKY_COOKIE = "db_primary"
+
+_current = ContextVar("thumbnails_db_routing", default=None)
+
+
+class RoutingState:
+    def __init__(self, sticky):
+        self.sticky = sticky
+        self.replica = False
+        self.written = False
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _current.get()
+        replicas = getattr(settings, "REPLICA_DATABASES", [])
+        if (
+            state is None
+            or not replicas
+            or not state.replica
+            or state.sticky
+            or state.written
+        ):
+            return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _current.get()
+        # reads after a write have to see it, even in the same request
+        if state is not None:
+            state.written = True
+        # instances read from replica would be written back to it otherwise
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in getattr(settings, "REPLICA_DATABASES", []):
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        state = RoutingState(STICKY_COOKIE in request.COOKIES)
+        token = _current.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, state, response)
+
+    async def __acall__(self, request):
+        state = RoutingState(STICKY_COOKIE in request.COOKIES)
+        token = _current.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, state, response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _current.get()
+        if (
+            state is not None
+            and request.method in SAFE_METHODS
+            and request.resolver_match
+            and request.resolver_match.url_name in settings.REPLICA_VIEWS
+        ):
+            state.replica = True
+        return None
+
+    def finish(self, request, state, response):
+        if state.written or request.method not in SAFE_METHODS:
+            response.set_cookie(
+                STICKY_COOKIE,
+                "1",
+                max_age=settings.REPLICA_STICKY_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
@@ -1,10 +1,13 @@
 from collections import OrderedDict
 
 from django.conf import settings
-from django.urls import reverse
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
 from rest_framework import serializers
 
-from .models import Image, ImageLink, Thumbnail, Tier
+from .models import Image, ImageLink, Thumbnail, Tier, UploadSession
+from .utils import delete_files, get_url_builder
 from .validators import Validator
 
 
@@ -17,8 +20,8 @@ class ModelSerializerWithToken(serializers.ModelSerializer):
     def get_url(self, obj):
         request = self.context.get("request")
         if obj.token:
-            return request.build_absolute_uri(
-                f"{reverse(f'{self.Meta.prefix}_view', kwargs={'token': obj.token})}"
+            return get_url_builder(request).url(
+                f"{self.Meta.prefix}_view", obj.token
             )
 
         return None
@@ -31,9 +34,13 @@ class RetrieveThumbnailSerializer(ModelSerializerWithToken):
 
     def get_url(self, obj):
         request = self.context.get("request")
-        height_list = [size.height for size in request.user.tier.sizes.all()]
-        if obj.height in height_list:
-            return super().get_url(obj)
+        height_list = self.context.get("tier_heights")
+        if height_list is None:
+            height_list = [
+                size.height for size in request.user.tier.sizes.all()
+            ]
+        if obj.height in height_list and obj.token:
+            return get_url_builder(request).thumbnail_url(obj)
 
         return None
 
@@ -64,10 +71,11 @@ class ListImageSerializer(serializers.ModelSerializer):
     binary = serializers.SerializerMethodField()
     image = serializers.SerializerMethodField()
     thumbnails = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Image
-        fields = ["image", "thumbnails", "binary"]
+        fields = ["image", "thumbnails", "srcset", "binary"]
 
     def to_representation(self, instance):
         results = super().to_representation(instance)
@@ -81,8 +89,13 @@ class ListImageSerializer(serializers.ModelSerializer):
 
     def get_binary(self, obj):
         request = self.context.get("request")
+        now = timezone.now()
         serializer = RetrieveLinkImageSerializer(
-            obj.expiring_link.all(),
+            [
+                link
+                for link in obj.expiring_link.all()
+                if link.valid_until > now
+            ],
             context={"request": request},
             many=True,
         )
@@ -101,13 +114,70 @@ class ListImageSerializer(serializers.ModelSerializer):
             return serializer.data
         return None
 
-    def get_thumbnails(self, obj):
+    def get_tier_heights(self):
         request = self.context.get("request")
+        if "tier_heights" not in self.context:
+            self.context["tier_heights"] = [
+                size.height for size in request.user.tier.sizes.all()
+            ]
+        return self.context["tier_heights"]
+
+    def get_thumbnails(self, obj):
+        self.get_tier_heights()
         serializer = RetrieveThumbnailSerializer(
-            obj.thumbnails, many=True, context={"request": request}
+            [thn for thn in self.get_variants(obj) if thn.density == 1],
+            many=True,
+            context=self.context,
         )
         return serializer.data
 
+    def get_srcset(self, obj):
+        tier_heights = self.get_tier_heights()
+        variants = [
+            thn
+            for thn in self.get_variants(obj)
+            if thn.height in tier_heights and thn.token
+        ]
+        if not variants:
+            return None
+
+        density = OrderedDict()
+        for thn in sorted(variants, key=lambda thn: (thn.height, thn.density)):
+            density.setdefault(thn.height, []).append(
+                "%s %sx" % (self.get_variant_url(thn), thn.density)
+            )
+        width = OrderedDict()
+        for thn in sorted(variants, key=lambda thn: thn.width or 0):
+            if thn.width and thn.width not in width:
+                width[thn.width] = "%s %sw" % (
+                    self.get_variant_url(thn),
+                    thn.width,
+                )
+        return OrderedDict(
+            [
+                (
+                    "density",
+                    OrderedDict(
+                        (height, ", ".join(urls))
+                        for height, urls in density.items()
+                    ),
+                ),
+                ("width", ", ".join(width.values())),
+            ]
+        )
+
+    def get_variants(self, obj):
+        request = self.context.get("request")
+        variants = obj.manifest_thumbnails(request.user.tier)
+        if variants is not None:
+            return variants
+        prefetch_related_objects([obj], "thumbnails")
+        return obj.thumbnails.all()
+
+    def get_variant_url(self, obj):
+        request = self.context.get("request")
+        return get_url_builder(request).thumbnail_url(obj)
+
 
 class CreateUpdateImageSerializer(serializers.ModelSerializer):
     user = serializers.HiddenField(default=serializers.CurrentUserDefault())
@@ -120,17 +190,35 @@ class CreateUpdateImageSerializer(serializers.ModelSerializer):
         ]
 
     def create(self, validated_data):
-        image = super().create(validated_data)
-        image.save_generated_token()
-        to_create, to_delete = image.check_thumbnails()
-        image.create_thumbnails(to_create)
+        image = Image(**validated_data)
+        image.token = image.generate_token()
+        thumbnails = []
+        try:
+            with transaction.atomic():
+                image.save()
+                to_create, to_delete = image.check_thumbnails()
+                thumbnails = image.create_thumbnails(to_create) or []
+                image.update_manifest(thumbnails)
+        except Exception:
+            delete_files(
+                [image.image]
+                + [thumbnail.thumbnail for thumbnail in thumbnails]
+            )
+            raise
         return image
 
     def update(self, instance, validated_data):
-        instance.thumbnails.all().delete()
-        image = super().update(instance, validated_data)
-        to_create, to_delete = image.check_thumbnails()
-        image.create_thumbnails(to_create)
+        thumbnails = []
+        try:
+            with transaction.atomic():
+                instance.thumbnails.all().delete()
+                image = super().update(instance, validated_data)
+                to_create, to_delete = image.check_thumbnails()
+                thumbnails = image.create_thumbnails(to_create) or []
+                image.update_manifest(thumbnails)
+        except Exception:
+            delete_files([thumbnail.thumbnail for thumbnail in thumbnails])
+            raise
         return image
 
     def validate_image(self, value):
@@ -139,3 +227,33 @@ class CreateUpdateImageSerializer(serializers.ModelSerializer):
         ):
             raise Validator.WRONG_FORMAT
         return value
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    user = serializers.HiddenField(default=serializers.CurrentUserDefault())
+    image = serializers.SlugRelatedField(
+        slug_field="token",
+        queryset=Image.objects.all(),
+        required=False,
+        allow_null=True,
+    )
+    length = serializers.IntegerField(
+        min_value=1, max_value=settings.UPLOAD_MAX_LENGTH
+    )
+
+    class Meta:
+        model = UploadSession
+        fields = ["filename", "length", "image", "user"]
+
+    def validate_filename(self, value):
+        if value.rsplit(".", 1)[-1].lower() not in Image.Formats.ALLOWED:
+            raise Validator.WRONG_FORMAT
+        return value
+
+    def validate_image(self, value):
+        user = self.context["request"].user
+        if value is not None and (
+            value.user_id != user.id or not user.tier.original_image
+        ):
+            raise serializers.ValidationError("Image not found.")
+        return value
@@ -0,0 +1,110 @@
+from django.contrib.auth import get_user_model
+from django.db.models import F
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+
+from .authentication import invalidate_tier, invalidate_user
+from .caching import bump_data_version
+from .models import (
+    Image,
+    ImageLink,
+    Size,
+    Thumbnail,
+    Tier,
+    image_soft_deleted,
+)
+
+
+def bump_tiers(tier_ids):
+    tier_ids = list(tier_ids)
+    Tier.objects.filter(pk__in=tier_ids).update(
+        policy_version=F("policy_version") + 1
+    )
+    for tier_id in tier_ids:
+        invalidate_tier(tier_id)
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+    bump_data_version(instance.pk)
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+@receiver(image_soft_deleted, sender=Image)
+def image_changed(sender, instance, **kwargs):
+    bump_data_version(instance.user_id)
+
+
+@receiver(post_save, sender=Thumbnail)
+@receiver(post_delete, sender=Thumbnail)
+@receiver(post_save, sender=ImageLink)
+@receiver(post_delete, sender=ImageLink)
+def image_child_changed(sender, instance, **kwargs):
+    if sender.image.is_cached(instance):
+        user_id = instance.image.user_id
+    else:
+        user_id = (
+            Image.objects.filter(pk=instance.image_id, shard=instance.shard)
+            .values_list("user_id", flat=True)
+            .first()
+        )
+    if user_id is not None:
+        bump_data_version(user_id)
+
+
+@receiver(post_save, sender=Thumbnail)
+@receiver(post_delete, sender=Thumbnail)
+def thumbnail_changed(sender, instance, **kwargs):
+    # rendering paths write the manifest themselves, other changes make
+    # the next request reconcile the image
+    Image.all_objects.filter(
+        pk=instance.image_id, shard=instance.shard
+    ).update(manifest={})
+
+
+@receiver(pre_save, sender=Tier)
+def tier_pre_save(sender, instance, **kwargs):
+    # stale instance, e.g. of admin form, would save a version issued before
+    if not instance._state.adding:
+        instance.policy_version = F("policy_version") + 1
+
+
+@receiver(post_save, sender=Tier)
+def tier_saved(sender, instance, created, **kwargs):
+    if not created:
+        instance.refresh_from_db(fields=["policy_version"])
+    invalidate_tier(instance.pk)
+
+
+@receiver(post_delete, sender=Tier)
+def tier_changed(sender, instance, **kwargs):
+    invalidate_tier(instance.pk)
+
+
+@receiver(post_save, sender=Size)
+@receiver(pre_delete, sender=Size)
+def size_changed(sender, instance, **kwargs):
+    if instance.pk:
+        bump_tiers(instance.tier.values_list("pk", flat=True))
+
+
+@receiver(m2m_changed, sender=Size.tier.through)
+def size_tiers_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return None
+    if reverse:
+        bump_tiers([instance.pk])
+    elif action == "pre_clear":
+        bump_tiers(instance.tier.values_list("pk", flat=True))
+    else:
+        bump_tiers(pk_set)
+    return None
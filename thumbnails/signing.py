@@ -0,0 +1,52 @@
+import base64
+import hashlib
+import hmac
+import time
+from urllib.parse import quote, urlencode
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def signature(secret, path, issued, expires):
+    message = "%s|%s|%s" % (path, issued, expires)
+    digest = hmac.new(
+        secret.encode(), message.encode(), hashlib.sha256
+    ).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def sign_path(path, issued=None):
+    if not settings.SIGNED_MEDIA_KEYS:
+        raise ImproperlyConfigured("SIGNED_MEDIA_KEYS are required")
+    # first key signs, the rest only verify until they are rotated out
+    kid, secret = next(iter(settings.SIGNED_MEDIA_KEYS.items()))
+    issued = int(time.time()) if issued is None else issued
+    expires = settings.SIGNED_MEDIA_URL_TTL
+    return {
+        "kid": kid,
+        "ts": issued,
+        "e": expires,
+        "st": signature(secret, path, issued, expires),
+    }
+
+
+def signed_media_url(base, name, issued=None):
+    path = quote(settings.MEDIA_URL + name)
+    return "%s%s?%s" % (base, path, urlencode(sign_path(path, issued)))
+
+
+def verify(path, params, now=None):
+    secret = settings.SIGNED_MEDIA_KEYS.get(params.get("kid"))
+    try:
+        issued, expires = int(params["ts"]), int(params["e"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    if secret is None or "st" not in params:
+        return False
+    now = time.time() if now is None else now
+    if not issued <= now + 60 or now > issued + expires:
+        return False
+    return hmac.compare_digest(
+        signature(secret, path, issued, expires), params["st"]
+    )
@@ -1,18 +1,53 @@
 import base64
+import hashlib
 import json
+import mmap
+import os
+import re
 import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from datetime import timedelta
+from io import BytesIO, StringIO
+from urllib.parse import parse_qsl
+from unittest import mock, skipUnless
 
-from django.contrib.auth import get_user_model
+import psycopg2
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import authenticate, get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
-from django.urls import reverse
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.db.utils import ConnectionHandler
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
 from django.utils import timezone
+from PIL import ExifTags, ImageCms
+from PIL import Image as Img
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.response import Response
 from rest_framework.test import (
     APIClient,
     APIRequestFactory,
     force_authenticate,
 )
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+
+from recruitment_task.pooled_postgresql.base import (
+    BlockingConnectionPool,
+    close_pools,
+)
 
 from thumbnails.validators import Validator
 from thumbnails.views import (
@@ -23,14 +58,42 @@ from thumbnails.views import (
     RetrieveUpdateDestroyImageView,
 )
 
+from .management.commands.collect_orphaned_media import orphaned_names
+from .authentication import (
+    CachedBasicAuthentication,
+    StatelessJWTAuthentication,
+)
+from . import uploads
+from .admin import EstimatedCountPaginator
+from .caching import list_ttl
+from .checks import check_image_shards, check_shared_caches
+from .idempotency import REPLAYED_HEADER, heartbeat, record_response
+from .instrumentation import Registry, clear_metrics_dir, registry
 from .middleware import DecodeBase64Middleware
-from .models import Image, ImageLink, Size, Tier
+from .models import (
+    IdempotencyRecord,
+    Image,
+    ImageLink,
+    RegenerationCheckpoint,
+    RenderBucket,
+    Size,
+    Thumbnail,
+    Tier,
+    UploadSession,
+    shard_for_user,
+    shard_from_token,
+)
+from .partitioning import is_partitioned, partition_tables
+from .routers import STICKY_COOKIE, ReplicaRouter, ReplicaRoutingMiddleware
 from .serializers import (
     CreateUpdateImageSerializer,
     ListImageSerializer,
     RetrieveImageSerializer,
     RetrieveThumbnailSerializer,
 )
+from .signing import sign_path, verify
+from .throttling import get_render_semaphore
+from .utils import get_url_builder, image_format_from_json, save_buffer
 
 
 class TestMixin(TestCase):
@@ -38,6 +101,7 @@ class TestMixin(TestCase):
     factory = APIRequestFactory()
 
     def setUp(self):
+        cache.clear()
         self.tier_basic = Tier.objects.create(tier=Tier.Tiers.BASIC)
         self.tier_premium = Tier.objects.create(
             tier=Tier.Tiers.PREMIUM, original_image=True
@@ -130,6 +194,233 @@ class TestImage(TestMixin):
         self.assertEqual(len(self.image.thumbnails.all()), 1)
 
 
+class TestThumbnailVariants(TestMixin):
+    def setUp(self):
+        super().setUp()
+        img_io = BytesIO()
+        Img.new("RGB", (1000, 500)).save(img_io, format="PNG")
+        self.image.image = SimpleUploadedFile(
+            "large.png", img_io.getvalue(), content_type="image/png"
+        )
+        self.image.save()
+
+    def test_create_density_variants(self):
+        thumbnails = self.image.create_thumbnails([200])
+        self.assertEqual(
+            [(thn.density, thn.width) for thn in thumbnails],
+            [(1, 200), (2, 400)],
+        )
+        self.assertEqual(
+            Img.open(thumbnails[1].thumbnail).size,
+            (400, 200),
+        )
+
+    def test_skip_variants_larger_than_source(self):
+        thumbnails = self.image.create_thumbnails([800])
+        self.assertEqual(
+            [(thn.density, thn.width) for thn in thumbnails],
+            [(1, 800), (2, 1000)],
+        )
+        thumbnails = self.image.create_thumbnails([1000])
+        self.assertEqual(len(thumbnails), 1)
+
+    def test_srcset_without_extra_queries(self):
+        thumbnails = self.image.create_thumbnails([200, 400])
+        request = self.factory.get("/")
+        request.user = self.user
+        image = Image.objects.prefetch_related("thumbnails").get(
+            pk=self.image.pk
+        )
+        serializer = ListImageSerializer(
+            image, context={"request": request}
+        )
+        serializer.fields["srcset"].to_representation(image)
+        with self.assertNumQueries(0):
+            srcset = serializer.fields["srcset"].to_representation(image)
+        url = "http://testserver/users/thumbnail/%s"
+        self.assertEqual(
+            srcset["density"][200],
+            "%s 1x, %s 2x"
+            % (url % thumbnails[0].token, url % thumbnails[1].token),
+        )
+        self.assertEqual(
+            srcset["width"],
+            "%s 200w, %s 400w, %s 800w"
+            % (
+                url % thumbnails[0].token,
+                url % thumbnails[1].token,
+                url % thumbnails[3].token,
+            ),
+        )
+
+
+class TestLocalFastPath(TestMixin):
+    def test_source_mapped_and_thumbnail_written_from_buffer(self):
+        with mock.patch(
+            "thumbnails.utils.mmap.mmap", wraps=mmap.mmap
+        ) as mapped:
+            fast = self.image.create_thumbnails([200])[0]
+        self.assertTrue(mapped.called)
+        self.assertEqual(
+            Thumbnail.objects.get(pk=fast.pk).thumbnail.name,
+            fast.thumbnail.name,
+        )
+        self.image.thumbnails.all().delete()
+        with override_settings(THUMBNAIL_LOCAL_FAST_PATH=False):
+            slow = self.image.create_thumbnails([200])[0]
+        self.assertNotEqual(fast.thumbnail.name, slow.thumbnail.name)
+        self.assertEqual(fast.thumbnail.read(), slow.thumbnail.read())
+
+    def test_buffer_saved_under_available_name(self):
+        thumbnails = [Thumbnail(image=self.image) for _ in range(2)]
+        for thumbnail in thumbnails:
+            save_buffer(thumbnail.thumbnail, "same.png", BytesIO(b"data"))
+            self.addCleanup(thumbnail.thumbnail.delete, save=False)
+        names = {thumbnail.thumbnail.name for thumbnail in thumbnails}
+        self.assertEqual(len(names), 2)
+        for name in names:
+            with default_storage.open(name) as file:
+                self.assertEqual(file.read(), b"data")
+
+
+class TestSourceNormalization(TestMixin):
+    def upload(self, img, **params):
+        img_io = BytesIO()
+        img.save(img_io, format="JPEG", **params)
+        self.image.image = SimpleUploadedFile(
+            "photo.jpg", img_io.getvalue(), content_type="image/jpeg"
+        )
+        self.image.save()
+        thumbnail = self.image.create_thumbnails([50])[0]
+        return Img.open(thumbnail.thumbnail)
+
+    def test_exif_orientation_applied(self):
+        exif = Img.Exif()
+        exif[ExifTags.Base.Orientation] = 6
+        img = self.upload(Img.new("RGB", (200, 100)), exif=exif)
+        self.assertEqual(img.size, (25, 50))
+        self.assertNotIn("exif", img.info)
+
+    def test_icc_profile_converted_and_stripped(self):
+        icc_profile = ImageCms.ImageCmsProfile(
+            ImageCms.createProfile("sRGB")
+        ).tobytes()
+        with mock.patch(
+            "thumbnails.models.ImageCms.applyTransform",
+            wraps=ImageCms.applyTransform,
+        ) as apply_transform:
+            img = self.upload(
+                Img.new("RGB", (100, 100), (200, 10, 10)),
+                icc_profile=icc_profile,
+            )
+        self.assertTrue(apply_transform.call_args.kwargs["inPlace"])
+        self.assertNotIn("icc_profile", img.info)
+        self.assertEqual(img.size, (50, 50))
+
+
+class TestAnimatedThumbnails(TestMixin):
+    def setUp(self):
+        super().setUp()
+        frames = [
+            Img.new("RGB", (100, 100), (i * 20, 0, 0)) for i in range(12)
+        ]
+        img_io = BytesIO()
+        frames[0].save(
+            img_io,
+            format="GIF",
+            save_all=True,
+            append_images=frames[1:],
+            duration=50,
+            loop=0,
+        )
+        self.image.image = SimpleUploadedFile(
+            "animated.gif", img_io.getvalue(), content_type="image/gif"
+        )
+        self.image.save()
+
+    @override_settings(THUMBNAIL_MAX_FRAMES=4)
+    def test_animated_thumbnail_with_frame_budget(self):
+        self.tier_premium.animated_thumbnails = True
+        self.tier_premium.save()
+        thumbnail = self.image.create_thumbnails([50])[0]
+        img = Img.open(thumbnail.thumbnail)
+        self.assertEqual(img.size, (50, 50))
+        self.assertEqual(img.n_frames, 4)
+        self.assertEqual(img.info["duration"], 150)
+
+    def test_token_user_update_keeps_animation(self):
+        self.tier_premium.animated_thumbnails = True
+        self.tier_premium.save()
+        access = APIClient().post(
+            "/users/login", {"username": "test", "password": "password"}
+        ).data["access"]
+        self.assertTrue(AccessToken(access)["animated_thumbnails"])
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        self.image.image.open("rb")
+        content = self.image.image.read()
+        with mock.patch.object(
+            JWTAuthentication, "get_user", side_effect=AssertionError
+        ):
+            response = client.put(
+                f"/users/image/{self.image.token}",
+                {
+                    "image": SimpleUploadedFile(
+                        "animated.gif", content, content_type="image/gif"
+                    )
+                },
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, 200)
+        for thumbnail in self.image.thumbnails.all():
+            self.assertGreater(Img.open(thumbnail.thumbnail).n_frames, 1)
+
+    def test_icc_profile_converted_in_every_frame(self):
+        icc_profile = ImageCms.ImageCmsProfile(
+            ImageCms.createProfile("sRGB")
+        ).tobytes()
+        frames = [
+            Img.new("RGB", (100, 100), (i * 60, 0, 0)) for i in range(3)
+        ]
+        img_io = BytesIO()
+        frames[0].save(
+            img_io,
+            format="WEBP",
+            save_all=True,
+            append_images=frames[1:],
+            icc_profile=icc_profile,
+        )
+        self.image.image = SimpleUploadedFile(
+            "animated.webp", img_io.getvalue(), content_type="image/webp"
+        )
+        self.image.save()
+        self.tier_premium.animated_thumbnails = True
+        self.tier_premium.save()
+        with mock.patch(
+            "thumbnails.models.ImageCms.applyTransform",
+            wraps=ImageCms.applyTransform,
+        ) as apply_transform:
+            thumbnail = self.image.create_thumbnails([50])[0]
+        # poster is converted from a copy, then each frame
+        self.assertEqual(apply_transform.call_count, 4)
+        self.assertNotIn("inPlace", apply_transform.call_args_list[0].kwargs)
+        self.assertEqual(Img.open(thumbnail.thumbnail).n_frames, 3)
+
+    def test_poster_frame_for_tier_without_animation(self):
+        thumbnail = self.image.create_thumbnails([50])[0]
+        img = Img.open(thumbnail.thumbnail)
+        self.assertEqual(img.format, "GIF")
+        self.assertEqual(img.n_frames, 1)
+
+    def test_base64_format_detection(self):
+        content = base64.b64encode(self.image.image.read()).decode()
+        self.assertEqual(image_format_from_json(content), (".gif", "GIF"))
+        img_io = BytesIO()
+        Img.new("RGB", (1, 1)).save(img_io, format="WEBP")
+        content = base64.b64encode(img_io.getvalue()).decode()
+        self.assertEqual(image_format_from_json(content), (".webp", "WEBP"))
+
+
 class TestImageLink(TestMixin):
     def test_image_link_generate(self):
         image_link = self.image.generate_image_link()
@@ -215,7 +506,7 @@ class TestListImageSerializer(TestMixin):
         serializer = ListImageSerializer(
             self.image, context={"request": request}
         )
-        self.assertEqual(len(list(serializer.data)), 1)
+        self.assertEqual(len(list(serializer.data)), 2)
         self.assertEqual(
             list(serializer.data["thumbnails"][0])[0], thumbnails[0].height
         )
@@ -237,7 +528,7 @@ class TestListImageSerializer(TestMixin):
             list(serializer.data["thumbnails"][1])[0], thumbnails[1].height
         )
         self.assertNotEqual(serializer.data["image"], None)
-        self.assertEqual(len(serializer.data), 2)
+        self.assertEqual(len(serializer.data), 3)
         self.assertEqual(len(serializer.data["thumbnails"]), 2)
 
     def test_serializing_model_with_tier_enterprise(self):
@@ -251,7 +542,7 @@ class TestListImageSerializer(TestMixin):
         serializer = ListImageSerializer(
             self.image, context={"request": request}
         )
-        self.assertEqual(len(serializer.data), 3)
+        self.assertEqual(len(serializer.data), 4)
         self.assertEqual(len(serializer.data["thumbnails"]), 2)
         self.assertEqual(
             list(serializer.data["thumbnails"][0])[0], thumbnails[0].height
@@ -263,6 +554,77 @@ class TestListImageSerializer(TestMixin):
         self.assertNotEqual(serializer.data["binary"], None)
 
 
+class TestThumbnailManifest(TestMixin):
+    def create_image(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        image = SimpleUploadedFile(
+            "manifest.png", self.image_content, "image/png"
+        )
+        response = client.post("/users/image/", {"image": image})
+        self.assertEqual(response.status_code, 201)
+        return Image.objects.select_related("user__tier").get(
+            pk=Image.objects.latest("pk").pk
+        ), client
+
+    def test_manifest_written_with_thumbnails(self):
+        image, client = self.create_image()
+        self.tier_premium.refresh_from_db()
+        self.assertEqual(
+            image.manifest["policy"],
+            [self.tier_premium.pk, self.tier_premium.policy_version],
+        )
+        self.assertEqual(set(image.manifest["heights"]), {"200", "400"})
+        for thumbnail in image.thumbnails.all():
+            entry = image.manifest["heights"][str(thumbnail.height)][0]
+            self.assertEqual(entry["token"], thumbnail.token)
+            self.assertEqual(entry["name"], thumbnail.thumbnail.name)
+            self.assertEqual(
+                entry["sha256"],
+                hashlib.sha256(thumbnail.thumbnail.read()).hexdigest(),
+            )
+
+    def test_current_manifest_skips_reconciliation_queries(self):
+        image, client = self.create_image()
+        with self.assertNumQueries(0):
+            image.update_thumbnails_after_changes()
+        request = self.factory.get("/")
+        request.user = self.user
+        with_manifest = ListImageSerializer(
+            image, context={"request": request}
+        ).data
+        image.manifest = {}
+        self.assertEqual(
+            ListImageSerializer(image, context={"request": request}).data,
+            with_manifest,
+        )
+
+    def test_policy_change_reconciles_and_rewrites_manifest(self):
+        image, client = self.create_image()
+        Size.objects.create(height=600).tier.add(self.tier_premium)
+        image = Image.objects.select_related("user__tier").get(pk=image.pk)
+        self.assertFalse(image.manifest_is_current())
+        image.update_thumbnails_after_changes()
+        self.assertEqual(
+            set(Image.objects.get(pk=image.pk).manifest["heights"]),
+            {"200", "400", "600"},
+        )
+
+    def test_deleted_thumbnail_clears_manifest(self):
+        image, client = self.create_image()
+        thumbnail = image.thumbnails.get(height=400)
+        thumbnail.delete()
+        self.assertEqual(Image.objects.get(pk=image.pk).manifest, {})
+        response = client.get(
+            "/users/thumbnail/%s" % image.thumbnails.get(height=200).token
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            set(Image.objects.get(pk=image.pk).manifest["heights"]),
+            {"200", "400"},
+        )
+
+
 class TestCreateUpdateSerializer(TestMixin):
     def test_create_image_model(self):
         content = base64.b64decode(
@@ -302,11 +664,12 @@ class TestCreateUpdateSerializer(TestMixin):
         self.assertNotEqual(image.image, image)
 
     def test_validate_image(self):
-        content = b"GIF87a\x01\x00\x01\x00\x80\x01\x00\x00\x00\x00ccc,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+        img_io = BytesIO()
+        Img.new("RGB", (1, 1)).save(img_io, format="BMP")
         image_data = SimpleUploadedFile(
-            "image.gif",
-            content,
-            content_type="image/gif",
+            "image.bmp",
+            img_io.getvalue(),
+            content_type="image/bmp",
         )
         request = self.factory.get("/")
         request.user = self.user
@@ -417,6 +780,713 @@ class TestImageCreateListView(TestMixin):
         self.assertEqual(len(response.data[0]["thumbnails"]), 1)
 
 
+class TestUrlBuilder(TestMixin):
+    def test_url_matches_reverse(self):
+        request = self.factory.get("/users/image/")
+        builder = get_url_builder(request)
+        self.assertIs(get_url_builder(request), builder)
+        self.assertEqual(
+            builder.url("thumbnail_view", "abc"),
+            request.build_absolute_uri(
+                reverse("thumbnail_view", kwargs={"token": "abc"})
+            ),
+        )
+
+    def test_routes_resolved_once_per_request(self):
+        request = self.factory.get("/users/image/")
+        builder = get_url_builder(request)
+        with mock.patch("thumbnails.utils.reverse", wraps=reverse) as rev:
+            for token in ("a", "b", "c"):
+                builder.url("image_view", token)
+        self.assertEqual(rev.call_count, 1)
+
+    @override_settings(MEDIA_DOMAIN="https://cdn.example.com/")
+    def test_media_domain(self):
+        request = self.factory.get("/users/image/")
+        self.assertEqual(
+            get_url_builder(request).url("binary_view", "abc"),
+            "https://cdn.example.com/users/binary/abc",
+        )
+
+
+@override_settings(
+    SIGNED_MEDIA_URLS=True,
+    SIGNED_MEDIA_URL_TTL=600,
+    SIGNED_MEDIA_KEYS={"2": "new-secret", "1": "old-secret"},
+)
+class TestSignedMediaUrls(TestMixin):
+    def signed_url(self):
+        thumbnail = self.image.create_thumbnails([200])[0]
+        request = self.factory.get("/users/image/")
+        request.user = self.user
+        url = RetrieveThumbnailSerializer(
+            thumbnail, context={"request": request}
+        ).data[200]
+        path, query = url[len("http://testserver") :].split("?")
+        return thumbnail, path, dict(parse_qsl(query))
+
+    def test_list_returns_signed_media_url(self):
+        thumbnail, path, params = self.signed_url()
+        self.assertEqual(path, "/media/" + thumbnail.thumbnail.name)
+        self.assertEqual(params["kid"], "2")
+        self.assertTrue(verify(path, params))
+        self.assertFalse(verify(path + "x", params))
+        self.assertFalse(verify(path, {**params, "e": "6000"}))
+
+    def test_signed_url_expires(self):
+        thumbnail, path, params = self.signed_url()
+        self.assertFalse(verify(path, params, now=int(params["ts"]) + 601))
+
+    def test_rotated_key_still_verifies(self):
+        issued = int(time.time())
+        with override_settings(SIGNED_MEDIA_KEYS={"1": "old-secret"}):
+            params = sign_path("/media/a.png", issued)
+        self.assertTrue(verify("/media/a.png", params))
+        with override_settings(SIGNED_MEDIA_KEYS={"2": "new-secret"}):
+            self.assertFalse(verify("/media/a.png", params))
+
+
+class TestRenderAdmission(TestMixin):
+    def upload(self):
+        request = self.factory.post(
+            "/users/image/",
+            {
+                "image": SimpleUploadedFile(
+                    "image.png", self.image_content, "image/png"
+                )
+            },
+        )
+        force_authenticate(request, user=self.user)
+        return ImageCreateListView.as_view()(request)
+
+    @override_settings(RENDER_RATES={"PREMIUM": "2/min"})
+    def test_token_bucket_per_tier(self):
+        self.assertEqual(self.upload().status_code, 201)
+        self.assertEqual(self.upload().status_code, 201)
+        response = self.upload()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "30")
+        request = self.factory.get("/users/image/")
+        force_authenticate(request, user=self.user)
+        response = ImageCreateListView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(
+        RENDER_RATES={"PREMIUM": "5/min"}, RENDER_GLOBAL_RATE="1/min"
+    )
+    def test_rejected_request_takes_no_token(self):
+        self.assertEqual(self.upload().status_code, 201)
+        self.assertEqual(self.upload().status_code, 429)
+        bucket = RenderBucket.objects.get(
+            key="throttle:render:user:%s" % self.user.pk
+        )
+        self.assertGreater(bucket.tokens, 3.9)
+
+    @override_settings(
+        RENDER_THROTTLE_BACKEND="thumbnails.throttling.CacheBuckets",
+        RENDER_RATES={"PREMIUM": "5/min"},
+        RENDER_GLOBAL_RATE="1/min",
+    )
+    def test_cache_buckets(self):
+        self.assertEqual(self.upload().status_code, 201)
+        response = self.upload()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "60")
+        self.assertFalse(RenderBucket.objects.exists())
+        tokens, updated = cache.get(
+            "throttle:render:user:%s" % self.user.pk
+        )
+        self.assertGreater(tokens, 3.9)
+
+    @override_settings(RENDER_RATES={"PREMIUM": "5/min"})
+    def test_idle_buckets_pruned(self):
+        now = timezone.now()
+        RenderBucket.objects.create(
+            key="idle", tokens=0, updated_at=now - timedelta(minutes=2)
+        )
+        RenderBucket.objects.create(
+            key="recent", tokens=0, updated_at=now - timedelta(seconds=30)
+        )
+        out = StringIO()
+        call_command("purge_deleted_images", stdout=out)
+        self.assertIn("Removed 1 idle render buckets", out.getvalue())
+        self.assertEqual(
+            list(RenderBucket.objects.values_list("key", flat=True)),
+            ["recent"],
+        )
+
+    @override_settings(RENDER_RATES={"PREMIUM": "1/min"})
+    def test_delete_not_limited(self):
+        self.assertEqual(self.upload().status_code, 201)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        for image in Image.objects.all():
+            response = client.delete(
+                reverse("image_view", kwargs={"token": image.token})
+            )
+            self.assertEqual(response.status_code, 204)
+
+    @override_settings(RENDER_CONCURRENCY=1, RENDER_SLOT_TIMEOUT=0)
+    def test_render_concurrency_limit(self):
+        semaphore = get_render_semaphore(1)
+        semaphore.acquire()
+        try:
+            response = self.upload()
+        finally:
+            semaphore.release()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(self.upload().status_code, 201)
+
+
+class TestIdempotentUpload(TestMixin):
+    def post(self, key, content=None):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        image = SimpleUploadedFile(
+            "image.png", content or self.image_content, "image/png"
+        )
+        return client.post(
+            "/users/image/", {"image": image}, HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_first_response(self):
+        first = self.post("retry")
+        self.assertEqual(first.status_code, 201)
+        images = Image.objects.count()
+        with mock.patch.object(Image, "create_thumbnails") as render:
+            second = self.post("retry")
+        render.assert_not_called()
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second[REPLAYED_HEADER], "true")
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(Image.objects.count(), images)
+        self.assertEqual(self.post("other").status_code, 201)
+        self.assertEqual(Image.objects.count(), images + 1)
+
+    @override_settings(RENDER_RATES={"PREMIUM": "1/min"})
+    def test_replay_not_throttled(self):
+        self.assertEqual(self.post("once").status_code, 201)
+        response = self.post("once")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response[REPLAYED_HEADER], "true")
+        self.assertEqual(self.post("other").status_code, 429)
+        # the key of other request doesn't skip the limit
+        img_io = BytesIO()
+        Img.new("RGB", (2, 2)).save(img_io, format="PNG")
+        self.assertEqual(
+            self.post("once", img_io.getvalue()).status_code, 429
+        )
+
+    def test_key_reused_with_other_payload(self):
+        self.assertEqual(self.post("reused", b"broken").status_code, 400)
+        # failed request doesn't keep the key
+        self.assertFalse(IdempotencyRecord.objects.exists())
+        self.assertEqual(self.post("reused").status_code, 201)
+        img_io = BytesIO()
+        Img.new("RGB", (2, 2)).save(img_io, format="PNG")
+        self.assertEqual(
+            self.post("reused", img_io.getvalue()).status_code, 422
+        )
+
+    @override_settings(IDEMPOTENCY_WAIT=5, IDEMPOTENCY_POLL_INTERVAL=0)
+    def test_duplicate_waits_for_first_request(self):
+        record = IdempotencyRecord.objects.create(
+            user=self.user, key="slow", fingerprint="same"
+        )
+
+        def finish(seconds):
+            IdempotencyRecord.objects.filter(pk=record.pk).update(
+                status_code=201, response={"image": {"url": "first"}}
+            )
+
+        with mock.patch(
+            "thumbnails.idempotency.request_fingerprint",
+            return_value="same",
+        ), mock.patch(
+            "thumbnails.idempotency.time.sleep", side_effect=finish
+        ) as sleep:
+            response = self.post("slow")
+        sleep.assert_called_once()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {"image": {"url": "first"}})
+
+    @override_settings(IDEMPOTENCY_WAIT=0)
+    def test_unfinished_duplicate_conflicts(self):
+        IdempotencyRecord.objects.create(
+            user=self.user, key="busy", fingerprint="same"
+        )
+        with mock.patch(
+            "thumbnails.idempotency.request_fingerprint",
+            return_value="same",
+        ):
+            response = self.post("busy")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Image.objects.count(), 1)
+
+    @override_settings(IDEMPOTENCY_WAIT=0, IDEMPOTENCY_LOCK_TIMEOUT=60)
+    def test_only_stopped_request_taken_over(self):
+        record = IdempotencyRecord.objects.create(
+            user=self.user, key="old", fingerprint="same"
+        )
+        old = timezone.now() - timedelta(seconds=120)
+        # slow request keeps its heartbeat fresh
+        IdempotencyRecord.objects.filter(pk=record.pk).update(created_at=old)
+        with mock.patch(
+            "thumbnails.idempotency.request_fingerprint",
+            return_value="same",
+        ):
+            self.assertEqual(self.post("old").status_code, 409)
+            IdempotencyRecord.objects.filter(pk=record.pk).update(
+                heartbeat_at=old
+            )
+            self.assertEqual(self.post("old").status_code, 201)
+        self.assertFalse(IdempotencyRecord.objects.filter(pk=record.pk))
+
+    def test_taken_over_request_keeps_new_record(self):
+        record = IdempotencyRecord.objects.create(
+            user=self.user, key="taken", fingerprint="same"
+        )
+
+        def take_over():
+            IdempotencyRecord.objects.filter(pk=record.pk).delete()
+            IdempotencyRecord.objects.create(
+                user=self.user, key="taken", fingerprint="same"
+            )
+            return Response(status=201, data={"image": "first"})
+
+        response = record_response(record, take_over)
+        self.assertEqual(response.status_code, 201)
+        duplicate = IdempotencyRecord.objects.get(key="taken")
+        self.assertIsNone(duplicate.status_code)
+        self.assertIsNone(duplicate.response)
+
+    @override_settings(IDEMPOTENCY_HEARTBEAT_INTERVAL=0)
+    def test_heartbeat_refreshed_while_processing(self):
+        record = IdempotencyRecord.objects.create(
+            user=self.user, key="beat", fingerprint="same"
+        )
+        beaten = threading.Event()
+        with mock.patch(
+            "thumbnails.idempotency.IdempotencyRecord"
+        ) as model:
+            model.objects.filter.return_value.update.side_effect = (
+                lambda **fields: beaten.set()
+            )
+            with heartbeat(record):
+                self.assertTrue(beaten.wait(5))
+        model.objects.filter.assert_called_with(
+            pk=record.pk, status_code__isnull=True
+        )
+
+
+class TestSharding(TestMixin):
+    def upload(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        image = SimpleUploadedFile(
+            "image.png", self.image_content, "image/png"
+        )
+        response = client.post("/users/image/", {"image": image})
+        self.assertEqual(response.status_code, 201)
+        return client, Image.objects.latest("pk")
+
+    def test_rows_of_image_share_shard_of_user(self):
+        client, image = self.upload()
+        shard = shard_for_user(self.user.pk)
+        self.assertEqual(image.shard, shard)
+        link = image.generate_image_link()
+        for obj in [image, link] + list(image.thumbnails.all()):
+            self.assertEqual(obj.shard, shard)
+            self.assertEqual(shard_from_token(obj.token), shard)
+        self.assertIsNone(shard_from_token(secrets.token_urlsafe(16)))
+
+    def test_shards_fit_token_length(self):
+        for shards, errors in ((100, []), (0, ["thumbnails.E002"])):
+            with override_settings(IMAGE_SHARDS=shards):
+                self.assertEqual(
+                    [error.id for error in check_image_shards(None)], errors
+                )
+        with override_settings(IMAGE_SHARDS=1000):
+            errors = check_image_shards(None)
+        self.assertEqual([error.id for error in errors], ["thumbnails.E002"])
+        self.assertEqual(errors[0].hint, "Use from 1 to 100 shards.")
+
+    def test_token_without_shard_hint_is_found(self):
+        client, image = self.upload()
+        thumbnail = image.thumbnails.first()
+        thumbnail.token = secrets.token_urlsafe(16)
+        thumbnail.save()
+        response = client.get("/users/thumbnail/%s" % thumbnail.token)
+        self.assertEqual(response.status_code, 200)
+        wrong_shard = "%s.%s" % (
+            (thumbnail.shard + 1) % settings.IMAGE_SHARDS,
+            thumbnail.token,
+        )
+        response = client.get("/users/thumbnail/%s" % wrong_shard)
+        self.assertEqual(response.status_code, 404)
+
+    def test_soft_delete_filters_by_shard(self):
+        client, image = self.upload()
+        image.generate_image_link()
+        self.assertEqual(len(client.get("/users/image/").data), 2)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.delete(
+                reverse("image_view", kwargs={"token": image.token})
+            )
+        self.assertEqual(response.status_code, 204)
+        updates = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith("UPDATE")
+        ]
+        self.assertEqual(len(updates), 3)
+        for sql in updates:
+            self.assertIn('"shard" = %s' % image.shard, sql)
+        # list cache is invalidated without post_save
+        self.assertEqual(len(client.get("/users/image/").data), 1)
+
+    @skipUnless(connection.vendor == "postgresql", "requires PostgreSQL")
+    def test_partitioned_lookup_scans_one_partition(self):
+        with connection.cursor() as cursor:
+            # tables with pending deferred checks can't be altered
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        partition_tables(connection, settings.IMAGE_SHARDS)
+        self.assertTrue(is_partitioned(connection, "thumbnails_thumbnail"))
+        self.assertEqual(Image.all_objects.get().pk, self.image.pk)
+        client, image = self.upload()
+        thumbnail = image.thumbnails.first()
+        response = client.get("/users/thumbnail/%s" % thumbnail.token)
+        self.assertEqual(response.status_code, 200)
+        plan = (
+            Thumbnail.objects.select_related("image")
+            .filter(
+                token=thumbnail.token,
+                shard=image.shard,
+                image__shard=image.shard,
+            )
+            .explain()
+        )
+        partitions = {
+            "thumbnails_thumbnail_p%s" % image.shard,
+            "thumbnails_image_p%s" % image.shard,
+        }
+        scanned = set(re.findall(r"thumbnails_\w+_p\d+", plan))
+        self.assertEqual(scanned, partitions)
+        response = client.get("/users/image/")
+        self.assertEqual(len(response.data), 2)
+
+
+class TestResumableUpload(TestMixin):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        override = override_settings(UPLOAD_SESSION_DIR=directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        img_io = BytesIO()
+        Img.effect_noise((300, 300), 50).save(img_io, format="PNG")
+        self.content = img_io.getvalue()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_session(self):
+        response = self.client.post(
+            reverse("upload_list"),
+            {"filename": "large.png"},
+            format="json",
+            HTTP_UPLOAD_LENGTH=str(len(self.content)),
+        )
+        self.assertEqual(response.status_code, 201)
+        return response["Location"]
+
+    def patch(self, location, offset, chunk):
+        return self.client.generic(
+            "PATCH",
+            location,
+            chunk,
+            content_type="application/offset+octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_upload_in_chunks(self):
+        location = self.create_session()
+        half = len(self.content) // 2
+        response = self.patch(location, 0, self.content[:half])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response["Upload-Offset"], str(half))
+        self.assertEqual(
+            self.client.head(location)["Upload-Offset"], str(half)
+        )
+        self.assertEqual(
+            self.patch(location, half, self.content[half:]).status_code, 204
+        )
+        response = self.client.post(
+            location + "/finalize",
+            {"sha256": hashlib.sha256(self.content).hexdigest()},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data["thumbnails"]), 2)
+        image = Image.objects.exclude(pk=self.image.pk).get()
+        self.assertEqual(image.image.read(), self.content)
+        self.assertEqual(self.client.head(location).status_code, 404)
+
+    def test_offset_mismatch_and_incomplete_upload(self):
+        location = self.create_session()
+        response = self.patch(location, 10, self.content[10:20])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Upload-Offset"], "0")
+        response = self.patch(location, 0, self.content[:10])
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post(location + "/finalize")
+        self.assertEqual(response.status_code, 409)
+
+    def test_concurrent_chunk_conflicts(self):
+        location = self.create_session()
+        session = UploadSession.objects.get()
+        with uploads.append_lock(session) as locked:
+            self.assertTrue(locked)
+            response = self.patch(location, 0, self.content[:10])
+        self.assertEqual(response.status_code, 409)
+        # offset was advanced by other request meanwhile
+        original = uploads.append_chunk
+
+        def append_elsewhere(session, stream):
+            UploadSession.objects.filter(pk=session.pk).update(offset=5)
+            return original(session, stream)
+
+        with mock.patch(
+            "thumbnails.views.append_chunk", side_effect=append_elsewhere
+        ):
+            response = self.patch(location, 0, self.content[:10])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(UploadSession.objects.get().offset, 5)
+
+    def test_expired_sessions_purged(self):
+        self.create_session()
+        session = UploadSession.objects.get()
+        UploadSession.objects.update(
+            created_at=timezone.now()
+            - timedelta(seconds=settings.UPLOAD_SESSION_TTL + 1)
+        )
+        orphan = os.path.join(settings.UPLOAD_SESSION_DIR, "orphan")
+        open(orphan, "wb").close()
+        os.utime(orphan, (0, 0))
+        call_command("purge_deleted_images", stdout=StringIO())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(session.path))
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_checksum_after_restart(self):
+        location = self.create_session()
+        self.patch(location, 0, self.content[:100])
+        # chunks handled by other process have no hasher in this one
+        uploads._hashers.clear()
+        self.patch(location, 100, self.content[100:])
+        response = self.client.post(
+            location + "/finalize", {"sha256": "0" * 64}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            location + "/finalize",
+            {"sha256": hashlib.sha256(self.content).hexdigest()},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+
+
+class TestAdminChangelists(TestMixin):
+    models = ("image", "thumbnail", "imagelink", "tier")
+
+    def setUp(self):
+        super().setUp()
+        admin = get_user_model().objects.create_superuser(
+            username="admin", password="password", email="admin@test.pl"
+        )
+        self.client.force_login(admin)
+        self.image.update_thumbnails()
+        self.image.generate_image_link()
+
+    def count_queries(self):
+        counts = []
+        for model in self.models:
+            url = reverse("admin:thumbnails_%s_changelist" % model)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            counts.append(len(queries))
+        return counts
+
+    def test_queries_do_not_grow_with_rows(self):
+        counts = self.count_queries()
+        for _ in range(3):
+            image = Image.objects.create(
+                user=self.user,
+                image=self.image_data,
+                token=secrets.token_urlsafe(16),
+            )
+            image.update_thumbnails()
+            image.generate_image_link()
+        Tier.objects.create(tier=Tier.Tiers.BASIC)
+        self.assertEqual(self.count_queries(), counts)
+
+    def test_image_owner_not_changed(self):
+        other = get_user_model().objects.create_user(
+            username="other", password="password"
+        )
+        url = reverse("admin:thumbnails_image_change", args=[self.image.pk])
+        response = self.client.get(url)
+        self.assertNotIn("user", response.context["adminform"].form.fields)
+        response = self.client.post(url, {"user": other.pk})
+        self.assertEqual(response.status_code, 302)
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.user, self.user)
+        self.assertEqual(self.image.shard, shard_for_user(self.user.pk))
+        # owner is chosen when the image is added
+        response = self.client.get(reverse("admin:thumbnails_image_add"))
+        self.assertIn("user", response.context["adminform"].form.fields)
+
+    @skipUnless(connection.vendor == "postgresql", "requires PostgreSQL")
+    @override_settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=0)
+    def test_estimated_count(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE thumbnails_thumbnail")
+        paginator = EstimatedCountPaginator(
+            Thumbnail.objects.order_by("pk"), 100
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(paginator.count, 2)
+        self.assertIn("reltuples", queries[0]["sql"])
+        paginator = EstimatedCountPaginator(
+            Thumbnail.objects.filter(height=200).order_by("pk"), 100
+        )
+        self.assertEqual(paginator.count, 1)
+        # default manager of images hides soft deleted ones
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE thumbnails_image")
+        paginator = EstimatedCountPaginator(Image.objects.order_by("pk"), 100)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(paginator.count, 1)
+        self.assertIn("reltuples", queries[0]["sql"])
+
+
+class TestSoftDelete(TestMixin):
+    def setUp(self):
+        super().setUp()
+        self.thumbnails = self.image.update_thumbnails()
+        self.link = self.image.generate_image_link()
+        self.names = [self.image.image.name] + [
+            thumbnail.thumbnail.name for thumbnail in self.thumbnails
+        ]
+
+    def test_destroy_hides_image_immediately(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        thumbnail_url = reverse(
+            "thumbnail_view", kwargs={"token": self.thumbnails[0].token}
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = client.delete(
+                reverse("image_view", kwargs={"token": self.image.token})
+            )
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(
+            any("DELETE" in query["sql"] for query in queries.captured_queries)
+        )
+        self.assertFalse(Image.objects.exists())
+        self.assertIsNotNone(Image.all_objects.get().deleted_at)
+        self.assertEqual(client.get(thumbnail_url).status_code, 404)
+        self.assertTrue(default_storage.exists(self.names[0]))
+
+    def test_purge_deletes_rows_and_files(self):
+        self.image.soft_delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("purge_deleted_images", stdout=StringIO())
+        self.assertFalse(Image.all_objects.exists())
+        self.assertFalse(Thumbnail.objects.exists())
+        self.assertFalse(ImageLink.objects.exists())
+        for name in self.names:
+            self.assertFalse(default_storage.exists(name))
+
+    def test_tier_delete_soft_deletes_images(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.tier_premium.delete()
+        self.assertFalse(
+            any(
+                "thumbnails_image" in query["sql"]
+                and query["sql"].startswith("DELETE")
+                for query in queries.captured_queries
+            )
+        )
+        self.assertFalse(get_user_model().objects.filter(pk=self.user.pk))
+        image = Image.all_objects.get()
+        self.assertIsNotNone(image.deleted_at)
+        self.assertIsNone(image.user_id)
+        self.assertIsNone(image.token)
+        self.assertFalse(Thumbnail.objects.exclude(token=None).exists())
+        self.assertFalse(ImageLink.objects.exclude(token=None).exists())
+        self.assertTrue(default_storage.exists(self.names[0]))
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("purge_deleted_images", stdout=StringIO())
+        self.assertFalse(Image.all_objects.exists())
+        self.assertFalse(Thumbnail.objects.exists())
+        self.assertFalse(default_storage.exists(self.names[0]))
+
+
+class TestListCache(TestMixin):
+    def list(self):
+        request = self.factory.get("/users/image/")
+        force_authenticate(request, user=self.user)
+        return ImageCreateListView.as_view()(request)
+
+    def test_list_served_from_cache(self):
+        first = self.list()
+        with CaptureQueriesContext(connection) as queries:
+            second = self.list()
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(len(queries), 0)
+
+    def test_changes_invalidate_list(self):
+        self.assertEqual(len(self.list().data), 1)
+        Image.objects.create(
+            user=self.user,
+            image=self.image_data,
+            token=secrets.token_urlsafe(16),
+        )
+        self.assertEqual(len(self.list().data), 2)
+        self.size_400.tier.remove(self.tier_premium)
+        self.assertEqual(len(self.list().data[0]["thumbnails"]), 1)
+
+    def test_local_memory_list_cache_fails_check(self):
+        with override_settings(
+            CACHES={
+                "default": settings.CACHES["default"],
+                "local": {
+                    "BACKEND": (
+                        "django.core.cache.backends.locmem.LocMemCache"
+                    )
+                },
+            },
+            LIST_CACHE="local",
+        ):
+            errors = check_shared_caches(None)
+        self.assertEqual([error.id for error in errors], ["thumbnails.E001"])
+        self.assertIn("LIST_CACHE", errors[0].msg)
+
+    def test_ttl_follows_earliest_link_expiry(self):
+        self.user.tier = self.tier_enterprise
+        self.user.save()
+        link = self.image.generate_image_link()
+        link.valid_until = timezone.now() + timedelta(seconds=30)
+        link.save()
+        self.assertEqual(len(self.list().data[0]["binary"]), 1)
+        self.assertTrue(0 < list_ttl(self.user) <= 30)
+        link.valid_until = timezone.now() - timedelta(seconds=1)
+        link.save()
+        self.assertNotIn("binary", self.list().data[0])
+
+
 # view/behavior tests
 class TestUploadAndRetrieveImage(TestMixin):
     def test_upload_and_retrieve_image(self):
@@ -492,3 +1562,678 @@ class TestUploadGenerateLinkAndRetrieveBinary(TestMixin):
         binary_url = response.data["url"]
         response = client.get(binary_url)
         self.assertEqual(response.status_code, 200)
+
+
+class TestAsyncRetrieveViews(TestMixin):
+    def setUp(self):
+        super().setUp()
+        self.image.create_thumbnails([200, 400])
+        self.auth = "Basic %s" % base64.b64encode(b"test:password").decode()
+
+    async def test_retrieve_thumbnail(self):
+        thumbnail = await self.image.thumbnails.filter(height=200).afirst()
+        response = await self.async_client.get(
+            f"/users/async/thumbnail/{thumbnail.token}",
+            AUTHORIZATION=self.auth,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        content = b"".join([chunk async for chunk in response])
+        self.assertEqual(int(response["Content-Length"]), len(content))
+
+    async def test_retrieve_image_unauthenticated(self):
+        response = await self.async_client.get(
+            f"/users/async/image/{self.image.token}"
+        )
+        self.assertEqual(response.status_code, 401)
+
+    async def test_retrieve_binary_without_permission(self):
+        image_link = await sync_to_async(self.image.generate_image_link)()
+        response = await self.async_client.get(
+            f"/users/async/binary/{image_link.token}",
+            AUTHORIZATION=self.auth,
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(SERVER_TIMING=True, METRICS_ALLOWED_IPS=["127.0.0.1"])
+class TestInstrumentation(TestMixin):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        override = override_settings(METRICS_DIR=self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_server_timing_on_upload(self):
+        registry.clear()
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.post(
+            "/users/image/",
+            {
+                "image": base64.b64encode(self.image_content).decode(),
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        phases = [
+            entry.split(";")[0].strip()
+            for entry in response["Server-Timing"].split(",")
+        ]
+        for phase in (
+            "base64_decode",
+            "sql",
+            "pillow_decode",
+            "pillow_resize",
+            "pillow_encode",
+            "storage_write",
+            "total",
+        ):
+            self.assertIn(phase, phases)
+
+    def test_metrics_endpoint(self):
+        registry.clear()
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.get(f"/users/image/{self.image.token}")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("storage_open", response["Server-Timing"])
+        metrics = client.get("/metrics").content.decode()
+        self.assertIn(
+            'thumbnails_phase_duration_seconds_count{phase="sql",'
+            'view="image_view"}',
+            metrics,
+        )
+        self.assertIn(
+            'thumbnails_request_duration_seconds_bucket{view="image_view",'
+            'le="+Inf"} 1',
+            metrics,
+        )
+
+    def test_metrics_of_workers_summed(self):
+        registry.clear()
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        client.get(f"/users/image/{self.image.token}")
+        worker = Registry()
+        worker.observe(
+            "thumbnails_request_duration_seconds", {"view": "image_view"}, 3
+        )
+        worker.inc("thumbnails_phase_operations_total", {"view": "other"}, 2)
+        with open(os.path.join(self.directory, "1.json"), "w") as file:
+            json.dump(worker.state(), file)
+        metrics = client.get("/metrics").content.decode()
+        self.assertIn(
+            'thumbnails_request_duration_seconds_bucket{view="image_view",'
+            'le="+Inf"} 2',
+            metrics,
+        )
+        self.assertIn(
+            'thumbnails_phase_operations_total{view="other"} 2', metrics
+        )
+        clear_metrics_dir()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @override_settings(METRICS_ALLOWED_IPS=[])
+    def test_metrics_endpoint_restricted(self):
+        self.assertEqual(APIClient().get("/metrics").status_code, 403)
+        client = APIClient(REMOTE_ADDR="10.0.0.5")
+        self.assertEqual(client.get("/metrics").status_code, 403)
+        client.force_login(self.user)
+        self.assertEqual(client.get("/metrics").status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(client.get("/metrics").status_code, 200)
+        with override_settings(METRICS_ALLOWED_IPS=["10.0.0.5"]):
+            client.logout()
+            self.assertEqual(client.get("/metrics").status_code, 200)
+
+
+class TestRenderProfiling(TestMixin):
+    def setUp(self):
+        super().setUp()
+        self.log = tempfile.NamedTemporaryFile(suffix=".log", delete=False)
+        self.log.close()
+        self.addCleanup(os.remove, self.log.name)
+
+    def test_slow_render_log(self):
+        with override_settings(
+            THUMBNAIL_PROFILING=True,
+            THUMBNAIL_SLOW_RENDER_THRESHOLD=0,
+            THUMBNAIL_SLOW_RENDER_LOG=self.log.name,
+        ):
+            self.image.create_thumbnails([200, 400])
+        with open(self.log.name) as file:
+            entry = json.loads(file.readline())
+        self.assertEqual(entry["image"], self.image.pk)
+        self.assertEqual(
+            entry["source"],
+            {
+                "width": 5,
+                "height": 5,
+                "mode": "RGBA",
+                "format": "PNG",
+                "frames": 1,
+            },
+        )
+        self.assertIn("pillow_decode", entry["phases"])
+        self.assertEqual(
+            [
+                (render["height"], render["density"])
+                for render in entry["renders"]
+            ],
+            [(200, 1), (400, 1)],
+        )
+        self.assertIn("pillow_encode", entry["renders"][0])
+
+        out = StringIO()
+        call_command("slow_renders", log=self.log.name, stdout=out)
+        self.assertIn("1 slow renders of 1 inputs", out.getvalue())
+        self.assertIn(self.image.image.name, out.getvalue())
+
+    def test_fast_render_not_logged(self):
+        with override_settings(
+            THUMBNAIL_PROFILING=True,
+            THUMBNAIL_SLOW_RENDER_THRESHOLD=60,
+            THUMBNAIL_SLOW_RENDER_LOG=self.log.name,
+        ):
+            self.image.create_thumbnails([200])
+        self.assertEqual(os.path.getsize(self.log.name), 0)
+
+
+class TestMediaAuthentication(TestMixin):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        response = APIClient().post(
+            "/users/login",
+            {"username": "test", "password": "password"},
+        )
+        self.access = response.data["access"]
+
+    def test_token_claims(self):
+        token = AccessToken(self.access)
+        self.assertEqual(token["tier_id"], self.tier_premium.pk)
+        self.assertEqual(token["tier"], Tier.Tiers.PREMIUM)
+        self.tier_premium.refresh_from_db()
+        self.assertEqual(
+            token["policy_version"], self.tier_premium.policy_version
+        )
+
+    def test_stateless_user_without_queries(self):
+        authentication = StatelessJWTAuthentication()
+        token = authentication.get_validated_token(self.access)
+        authentication.get_user(token)
+        with self.assertNumQueries(0):
+            user = authentication.get_user(token)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(user.tier.original_image, True)
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.access}")
+        response = client.get(f"/users/image/{self.image.token}")
+        self.assertEqual(response.status_code, 200)
+
+    def test_policy_change_falls_back_to_database(self):
+        authentication = StatelessJWTAuthentication()
+        token = authentication.get_validated_token(self.access)
+        self.size_400.tier.remove(self.tier_premium)
+        self.assertEqual(authentication.get_stateless_user(token), None)
+        self.assertEqual(authentication.get_user(token), self.user)
+
+        self.user.tier = self.tier_basic
+        self.user.save()
+        token = authentication.get_validated_token(self.access)
+        self.assertEqual(authentication.get_stateless_user(token), None)
+
+    def test_stale_tier_save_issues_new_version(self):
+        stale = Tier.objects.get(pk=self.tier_premium.pk)
+        self.size_400.tier.remove(self.tier_premium)
+        bumped = Tier.objects.get(pk=self.tier_premium.pk).policy_version
+        stale.original_image = False
+        stale.save()
+        self.assertEqual(stale.policy_version, bumped + 1)
+        self.assertEqual(
+            Tier.objects.get(pk=stale.pk).policy_version, bumped + 1
+        )
+
+    def test_local_memory_cache_fails_check(self):
+        self.assertEqual(check_shared_caches(None), [])
+        with override_settings(
+            CACHES={
+                "default": settings.CACHES["default"],
+                "local": {
+                    "BACKEND": (
+                        "django.core.cache.backends.locmem.LocMemCache"
+                    )
+                },
+            },
+            AUTH_CACHE="local",
+        ):
+            errors = check_shared_caches(None)
+        self.assertEqual([error.id for error in errors], ["thumbnails.E001"])
+
+    def test_cached_basic_credentials(self):
+        authentication = CachedBasicAuthentication()
+        with mock.patch(
+            "rest_framework.authentication.authenticate",
+            wraps=authenticate,
+        ) as authenticate_mock:
+            authentication.authenticate_credentials("test", "password")
+            user, _ = authentication.authenticate_credentials(
+                "test", "password"
+            )
+            self.assertEqual(authenticate_mock.call_count, 1)
+            self.assertEqual(user, self.user)
+
+            self.user.set_password("changed")
+            self.user.save()
+            with self.assertRaises(AuthenticationFailed):
+                authentication.authenticate_credentials("test", "password")
+
+
+class TestTransactionalCreate(TestMixin):
+    def create(self):
+        request = self.factory.get("/")
+        request.user = self.user
+        serializer = CreateUpdateImageSerializer(
+            data={
+                "image": SimpleUploadedFile(
+                    "test_image.png", self.image_content, "image/png"
+                )
+            },
+            context={"request": request},
+        )
+        serializer.is_valid(raise_exception=True)
+        return serializer.save()
+
+    def test_constant_number_of_queries(self):
+        self.create()
+        with CaptureQueriesContext(connection) as two_sizes:
+            self.create()
+        Size.objects.create(height=100).tier.add(self.tier_premium)
+        Size.objects.create(height=50).tier.add(self.tier_premium)
+        with CaptureQueriesContext(connection) as four_sizes:
+            image = self.create()
+        self.assertEqual(len(image.thumbnails.all()), 4)
+        self.assertEqual(
+            len(two_sizes.captured_queries), len(four_sizes.captured_queries)
+        )
+
+    def test_files_removed_on_rollback(self):
+        images = Image.objects.count()
+        with mock.patch(
+            "thumbnails.models.Thumbnail.objects.bulk_create",
+            side_effect=DatabaseError,
+        ), mock.patch.object(
+            default_storage, "delete", wraps=default_storage.delete
+        ) as delete:
+            with self.assertRaises(DatabaseError):
+                self.create()
+        self.assertEqual(Image.objects.count(), images)
+        self.assertEqual(delete.call_count, 3)
+        for call in delete.call_args_list:
+            self.assertFalse(default_storage.exists(call.args[0]))
+
+
+class TestCollectOrphanedMedia(TestMixin):
+    def setUp(self):
+        # the collector deletes every unreferenced file, keep it away from
+        # the configured media root
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        super().setUp()
+        self.thumbnails = self.image.create_thumbnails([200, 400])
+        self.orphan = default_storage.save(
+            "orphan.png", ContentFile(self.image_content)
+        )
+        self.addCleanup(default_storage.delete, self.orphan)
+
+    def test_orphaned_names(self):
+        self.assertEqual(
+            list(
+                orphaned_names(
+                    ["a.png", "a/b.png", "c.png", "d.png"],
+                    ["a/b.png", "b.png", "d.png"],
+                )
+            ),
+            ["a.png", "c.png"],
+        )
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command(
+            "collect_orphaned_media", dry_run=True, min_age=0, stdout=out
+        )
+        self.assertIn(self.orphan, out.getvalue().splitlines())
+        self.assertTrue(default_storage.exists(self.orphan))
+
+    def test_delete_orphans(self):
+        call_command(
+            "collect_orphaned_media", min_age=0, rate=1000, stdout=StringIO()
+        )
+        self.assertFalse(default_storage.exists(self.orphan))
+        self.assertTrue(default_storage.exists(self.image.image.name))
+        for thumbnail in self.thumbnails:
+            self.assertTrue(default_storage.exists(thumbnail.thumbnail.name))
+
+    def test_skip_recent_files(self):
+        call_command("collect_orphaned_media", stdout=StringIO())
+        self.assertTrue(default_storage.exists(self.orphan))
+
+
+class TestRegenerateThumbnails(TestMixin):
+    def setUp(self):
+        super().setUp()
+        self.image.create_thumbnails([200, 400])
+        self.second = Image.objects.create(
+            user=self.user,
+            image=SimpleUploadedFile(
+                "second.png", self.image_content, "image/png"
+            ),
+            token=secrets.token_urlsafe(16),
+        )
+        self.second.create_thumbnails([200, 400])
+
+    def tokens(self, image):
+        return set(image.thumbnails.values_list("token", flat=True))
+
+    def test_regenerate_all(self):
+        tokens = self.tokens(self.image)
+        out = StringIO()
+        call_command("regenerate_thumbnails", workers=0, stdout=out)
+        self.assertIn("2/2 images", out.getvalue())
+        self.assertEqual(len(self.tokens(self.image)), 2)
+        self.assertFalse(tokens & self.tokens(self.image))
+        checkpoint = RegenerationCheckpoint.objects.get(name="default")
+        self.assertEqual(checkpoint.processed, 2)
+        self.assertEqual(checkpoint.last_id, self.second.pk)
+        self.assertNotEqual(checkpoint.finished_at, None)
+
+    def test_resume_from_checkpoint(self):
+        RegenerationCheckpoint.objects.create(
+            name="default", last_id=self.image.pk
+        )
+        tokens = self.tokens(self.image)
+        second_tokens = self.tokens(self.second)
+        out = StringIO()
+        call_command("regenerate_thumbnails", workers=0, stdout=out)
+        self.assertIn("Resuming default after image", out.getvalue())
+        self.assertEqual(self.tokens(self.image), tokens)
+        self.assertFalse(second_tokens & self.tokens(self.second))
+
+    def test_filter_by_height(self):
+        kept = set(
+            self.image.thumbnails.filter(height=200).values_list(
+                "token", flat=True
+            )
+        )
+        call_command(
+            "regenerate_thumbnails",
+            workers=0,
+            height=[400],
+            user="test",
+            stdout=StringIO(),
+        )
+        self.assertEqual(len(self.tokens(self.image)), 2)
+        self.assertTrue(kept < self.tokens(self.image))
+
+    def test_regenerate_height_of_uploaded_image(self):
+        img_io = BytesIO()
+        Img.new("RGB", (1000, 1000)).save(img_io, format="PNG")
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(
+            "/users/image/",
+            {
+                "image": SimpleUploadedFile(
+                    "big.png", img_io.getvalue(), "image/png"
+                )
+            },
+        )
+        self.assertEqual(response.status_code, 201)
+        image = Image.objects.latest("pk")
+        variants = sorted(image.thumbnails.values_list("height", "density"))
+        self.assertEqual(variants, [(200, 1), (200, 2), (400, 1), (400, 2)])
+        replaced = set(
+            image.thumbnails.filter(height=400).values_list(
+                "token", flat=True
+            )
+        )
+        call_command(
+            "regenerate_thumbnails",
+            workers=0,
+            height=[400],
+            stdout=StringIO(),
+        )
+        self.assertEqual(
+            sorted(image.thumbnails.values_list("height", "density")),
+            variants,
+        )
+        self.assertFalse(replaced & self.tokens(image))
+
+    def test_backfill_new_height(self):
+        tokens = self.tokens(self.image)
+        Size.objects.create(height=600).tier.add(self.tier_premium)
+        out = StringIO()
+        call_command(
+            "regenerate_thumbnails", workers=0, height=[600], stdout=out
+        )
+        self.assertIn("2/2 images", out.getvalue())
+        self.assertTrue(tokens < self.tokens(self.image))
+        self.assertEqual(
+            sorted(
+                self.second.thumbnails.values_list("height", flat=True)
+            ),
+            [200, 400, 600],
+        )
+
+
+@skipUnless(connection.vendor == "postgresql", "requires PostgreSQL")
+class TestPooledConnections(TestCase):
+    def test_connection_reused_from_pool(self):
+        handler = ConnectionHandler(
+            {
+                "default": {
+                    **connection.settings_dict,
+                    "ENGINE": "recruitment_task.pooled_postgresql",
+                    "CONN_MAX_AGE": 0,
+                }
+            }
+        )
+        pooled = handler["default"]
+        self.addCleanup(close_pools)
+        pooled.ensure_connection()
+        raw_connection = pooled.connection
+        pooled.close_if_unusable_or_obsolete()
+        self.assertEqual(pooled.connection, None)
+        self.assertFalse(raw_connection.closed)
+        pooled.ensure_connection()
+        self.assertIs(pooled.connection, raw_connection)
+        pooled.close()
+
+    def test_exhausted_pool_waits_for_connection(self):
+        pool = BlockingConnectionPool(
+            1, 1, 0.01, **connection.get_connection_params()
+        )
+        self.addCleanup(pool.closeall)
+        first = pool.getconn()
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.getconn()
+        pool.timeout = 5
+        threading.Timer(0.1, pool.putconn, [first]).start()
+        self.assertIs(pool.getconn(), first)
+
+    def test_broken_pooled_connections_replaced(self):
+        handler = ConnectionHandler(
+            {
+                "default": {
+                    **connection.settings_dict,
+                    "ENGINE": "recruitment_task.pooled_postgresql",
+                    "CONN_MAX_AGE": 0,
+                    "CONN_HEALTH_CHECKS": True,
+                    "POOL": {"MIN": 3, "MAX": 3},
+                }
+            }
+        )
+        pooled = handler["default"]
+        self.addCleanup(close_pools)
+        pooled.ensure_connection()
+        pool = pooled.pool
+        pooled.close()
+        broken = [pool.getconn(), pool.getconn()]
+        with connection.cursor() as cursor:
+            for raw_connection in broken:
+                cursor.execute(
+                    "SELECT pg_terminate_backend(%s)",
+                    [raw_connection.info.backend_pid],
+                )
+        for raw_connection in broken:
+            pool.putconn(raw_connection)
+        pooled.ensure_connection()
+        self.assertNotIn(pooled.connection, broken)
+        with pooled.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        pooled.close()
+
+
+@override_settings(REPLICA_DATABASES=["replica"])
+class TestReplicaRouting(TestCase):
+    def route(self, method, path, write=False, cookies=None):
+        router = ReplicaRouter()
+        request = getattr(RequestFactory(), method)(path)
+        request.COOKIES.update(cookies or {})
+        request.resolver_match = resolve(path)
+        routed = []
+
+        def get_response(request):
+            middleware.process_view(request, None, (), {})
+            if write:
+                router.db_for_write(Image)
+            routed.append(router.db_for_read(Image))
+            return HttpResponse()
+
+        middleware = ReplicaRoutingMiddleware(get_response)
+        response = middleware(request)
+        return routed[0], response
+
+    def test_read_only_view_uses_replica(self):
+        db, response = self.route("get", reverse("image_list"))
+        self.assertEqual(db, "replica")
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        self.assertIsNone(ReplicaRouter().db_for_read(Image))
+
+    def test_write_sticks_client_to_primary(self):
+        db, response = self.route("post", reverse("image_list"))
+        self.assertIsNone(db)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        db, response = self.route(
+            "get", reverse("image_list"), cookies={STICKY_COOKIE: "1"}
+        )
+        self.assertIsNone(db)
+
+    def test_reads_after_write_in_request_use_primary(self):
+        db, response = self.route("get", reverse("image_list"), write=True)
+        self.assertIsNone(db)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+
+@override_settings(
+    REPLICA_DATABASES=["replica"],
+    DATABASE_ROUTERS=["thumbnails.routers.ReplicaRouter"],
+)
+class TestReplicaWrites(TestMixin):
+    def setUp(self):
+        super().setUp()
+        # second connection to the test database, not a mirror of default,
+        # so rows written through it are not seen by default
+        connections.settings["replica"] = dict(connection.settings_dict)
+        self.addCleanup(self.remove_replica)
+
+    def remove_replica(self):
+        connections["replica"].close()
+        del connections.settings["replica"]
+        if hasattr(connections._connections, "replica"):
+            delattr(connections._connections, "replica")
+
+    def from_replica(self, obj):
+        obj._state.db = "replica"
+        return obj
+
+    def test_writes_of_replica_instances_go_to_primary(self):
+        self.image.update_thumbnails()
+        link = self.image.generate_image_link()
+        ImageLink.objects.filter(pk=link.pk).update(
+            valid_until=timezone.now() - timedelta(seconds=1)
+        )
+        link = self.from_replica(ImageLink.objects.get(pk=link.pk))
+        image = self.from_replica(Image.objects.get(pk=self.image.pk))
+        with CaptureQueriesContext(connections["replica"]) as queries:
+            self.assertFalse(link.is_valid())
+            image.delete_thumbnails([400])
+        self.assertEqual(len(queries), 0)
+        self.assertFalse(ImageLink.objects.exists())
+        self.assertEqual(
+            list(
+                Thumbnail.objects.values_list("height", flat=True).distinct()
+            ),
+            [200],
+        )
+
+
+class TestStartup(TestCase):
+    def import_times(self):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                "import recruitment_task.wsgi",
+            ],
+            cwd=settings.BASE_DIR,
+            env=dict(
+                os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE
+            ),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            cumulative, name = line.split("|")[1:]
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1e6
+        return times
+
+    def test_startup_loads_only_listed_plugins(self):
+        times = self.import_times()
+        self.assertIn("thumbnails.views", times)
+        plugins = {
+            name for name in times if name.endswith("ImagePlugin")
+        }
+        self.assertEqual(
+            plugins,
+            {
+                "PIL.BmpImagePlugin",
+                "PIL.GifImagePlugin",
+                "PIL.JpegImagePlugin",
+                "PIL.PpmImagePlugin",
+                "PIL.PngImagePlugin",
+                "PIL.TiffImagePlugin",
+                "PIL.WebPImagePlugin",
+            },
+        )
+
+    def test_startup_within_import_budget(self):
+        # generous for shared CI runners, startup takes about 0.5 s
+        budget = float(os.environ.get("STARTUP_IMPORT_BUDGET", 2))
+        times = self.import_times()
+        self.assertLess(times["recruitment_task.wsgi"], budget)
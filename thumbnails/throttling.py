@@ -0,0 +1,198 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import Throttled
+from rest_framework.throttling import BaseThrottle, SimpleRateThrottle
+
+from .idempotency import is_replay
+from .models import RenderBucket
+
+# DELETE and reads don't render thumbnails
+RENDER_METHODS = ("POST", "PUT", "PATCH")
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def parse_rate(rate):
+    # (capacity, period in seconds) of e.g. "30/min"
+    return SimpleRateThrottle.parse_rate(None, rate)
+
+
+def refill(tokens, elapsed, capacity, period):
+    return min(capacity, tokens + max(elapsed, 0) * capacity / period)
+
+
+def take_from(tokens, rates):
+    # token is taken only when every bucket has one, tokens are updated in
+    # place, returns seconds until the emptiest bucket has one
+    wait = max(
+        (
+            (1 - tokens[key]) * period / capacity
+            for key, (capacity, period) in rates.items()
+            if tokens[key] < 1
+        ),
+        default=0,
+    )
+    if not wait:
+        for key in tokens:
+            tokens[key] -= 1
+    return wait
+
+
+class DatabaseBuckets:
+    # rows shared by all workers and hosts without Redis
+    def lock(self, keys):
+        # every request locks rows in the same order, so they don't deadlock
+        return list(
+            RenderBucket.objects.select_for_update()
+            .filter(key__in=keys)
+            .order_by("key")
+        )
+
+    def take(self, rates):
+        with transaction.atomic():
+            buckets = self.lock(rates)
+            if len(buckets) < len(rates):
+                now = timezone.now()
+                RenderBucket.objects.bulk_create(
+                    [
+                        RenderBucket(key=key, tokens=capacity, updated_at=now)
+                        for key, (capacity, period) in rates.items()
+                    ],
+                    ignore_conflicts=True,
+                )
+                buckets = self.lock(rates)
+            now = timezone.now()
+            tokens = {
+                bucket.key: refill(
+                    bucket.tokens,
+                    (now - bucket.updated_at).total_seconds(),
+                    *rates[bucket.key],
+                )
+                for bucket in buckets
+            }
+            wait = take_from(tokens, rates)
+            for bucket in buckets:
+                bucket.tokens = tokens[bucket.key]
+                bucket.updated_at = now
+            RenderBucket.objects.bulk_update(buckets, ["tokens", "updated_at"])
+        return wait
+
+    def prune(self, idle):
+        return RenderBucket.objects.filter(
+            updated_at__lt=timezone.now() - timedelta(seconds=idle)
+        ).delete()[0]
+
+
+class CacheBuckets:
+    # RENDER_THROTTLE_CACHE holds the buckets, local-memory cache keeps
+    # them per process. Takes are serialized by a lock key, which is atomic
+    # with caches of atomic add(local memory, Redis, Memcached)
+    lock_key = "throttle:render:lock"
+    lock_timeout = 5
+
+    def __init__(self):
+        self.cache = caches[settings.RENDER_THROTTLE_CACHE]
+
+    @contextmanager
+    def lock(self):
+        # lock of a crashed worker expires after lock_timeout
+        deadline = time.monotonic() + self.lock_timeout
+        while not self.cache.add(self.lock_key, 1, self.lock_timeout):
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            self.cache.delete(self.lock_key)
+
+    def take(self, rates):
+        with self.lock():
+            now = time.time()
+            stored = self.cache.get_many(list(rates))
+            tokens = {}
+            for key, (capacity, period) in rates.items():
+                value, updated = stored.get(key, (capacity, now))
+                tokens[key] = refill(value, now - updated, capacity, period)
+            wait = take_from(tokens, rates)
+            # idle bucket is full again after its period
+            for key, (capacity, period) in rates.items():
+                self.cache.set(key, (tokens[key], now), period)
+        return wait
+
+    def prune(self, idle):
+        return 0
+
+
+def get_buckets():
+    return import_string(settings.RENDER_THROTTLE_BACKEND)()
+
+
+def render_rates(user):
+    rates = {}
+    tier = user.tier
+    rate = settings.RENDER_RATES.get(tier.tier if tier else None)
+    if rate:
+        rates["throttle:render:user:%s" % user.pk] = parse_rate(rate)
+    if settings.RENDER_GLOBAL_RATE:
+        rates["throttle:render:global"] = parse_rate(
+            settings.RENDER_GLOBAL_RATE
+        )
+    return rates
+
+
+def prune_render_buckets():
+    # idle bucket is full after the period of its rate, a missing one
+    # starts full
+    rates = list(settings.RENDER_RATES.values())
+    rates.append(settings.RENDER_GLOBAL_RATE)
+    periods = [parse_rate(rate)[1] for rate in rates if rate]
+    return get_buckets().prune(max(periods, default=0))
+
+
+class RenderThrottle(BaseThrottle):
+    def allow_request(self, request, view):
+        self.wait_time = 0
+        if request.method not in RENDER_METHODS or is_replay(request):
+            return True
+        rates = render_rates(request.user)
+        if rates:
+            self.wait_time = get_buckets().take(rates)
+        return not self.wait_time
+
+    def wait(self):
+        return self.wait_time
+
+
+def get_render_semaphore(concurrency):
+    with _semaphores_lock:
+        semaphore = _semaphores.get(concurrency)
+        if semaphore is None:
+            semaphore = _semaphores[concurrency] = threading.BoundedSemaphore(
+                concurrency
+            )
+        return semaphore
+
+
+@contextmanager
+def render_slot():
+    if not settings.RENDER_CONCURRENCY:
+        yield
+        return
+    semaphore = get_render_semaphore(settings.RENDER_CONCURRENCY)
+    # queue shortly for a free slot, then let the client retry later
+    if not semaphore.acquire(timeout=settings.RENDER_SLOT_TIMEOUT):
+        raise Throttled(wait=1)
+    try:
+        yield
+    finally:
+        semaphore.release()
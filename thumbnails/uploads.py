@@ -0,0 +1,115 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+
+CHUNK_SIZE = 64 * 1024
+
+# sha256 state of sessions appended by this process, keyed by token
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class SessionUploadedFile(UploadedFile):
+    # lets Pillow validation and FileSystemStorage use the file in place
+    def __init__(self, session, content_type):
+        super().__init__(
+            open(session.path, "rb"),
+            session.filename,
+            content_type,
+            session.length,
+        )
+        self.path = session.path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def rehash(session):
+    hasher = hashlib.sha256()
+    with open(session.path, "rb") as file:
+        remaining = session.offset
+        while remaining:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+
+def get_hasher(session):
+    with _hashers_lock:
+        offset, hasher = _hashers.get(session.token, (None, None))
+    # chunks appended by other process are read again from the file
+    if offset != session.offset:
+        hasher = rehash(session)
+    return hasher.copy()
+
+
+@contextmanager
+def append_lock(session):
+    # chunks of one session are appended by one request at a time, without
+    # a database lock held while the body is read
+    with open(session.path, "ab") as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def append_chunk(session, stream):
+    hasher = get_hasher(session)
+    offset = session.offset
+    mode = "r+b" if os.path.exists(session.path) else "wb"
+    with open(session.path, mode) as file:
+        # bytes of interrupted request beyond offset are sent again
+        file.truncate(offset)
+        file.seek(offset)
+        while offset < session.length:
+            chunk = stream.read(min(CHUNK_SIZE, session.length - offset))
+            if not chunk:
+                break
+            file.write(chunk)
+            hasher.update(chunk)
+            offset += len(chunk)
+    session.offset = offset
+    with _hashers_lock:
+        _hashers[session.token] = (offset, hasher)
+    return offset
+
+
+def discard(session):
+    with _hashers_lock:
+        _hashers.pop(session.token, None)
+    # FileSystemStorage moves the file into MEDIA_ROOT
+    if os.path.exists(session.path):
+        os.remove(session.path)
+
+
+def remove_stale_files(tokens):
+    # files of sessions deleted with their users have no row
+    if not os.path.isdir(settings.UPLOAD_SESSION_DIR):
+        return 0
+    removed = 0
+    expires = time.time() - settings.UPLOAD_SESSION_TTL
+    with os.scandir(settings.UPLOAD_SESSION_DIR) as entries:
+        for entry in entries:
+            if (
+                entry.is_file()
+                and entry.name not in tokens
+                and entry.stat().st_mtime < expires
+            ):
+                os.remove(entry.path)
+                removed += 1
+    return removed
@@ -23,6 +23,36 @@ urlpatterns = [
         views.RetrieveBinaryImage.as_view(),
         name="binary_view",
     ),
+    path(
+        "async/image/<str:token>",
+        views.AsyncRetrieveImageView.as_view(),
+        name="async_image_view",
+    ),
+    path(
+        "async/thumbnail/<str:token>",
+        views.AsyncRetrieveThumbnailView.as_view(),
+        name="async_thumbnail_view",
+    ),
+    path(
+        "async/binary/<str:token>",
+        views.AsyncRetrieveBinaryImage.as_view(),
+        name="async_binary_view",
+    ),
+    path(
+        "upload/",
+        views.UploadSessionCreateView.as_view(),
+        name="upload_list",
+    ),
+    path(
+        "upload/<str:token>",
+        views.UploadSessionView.as_view(),
+        name="upload_view",
+    ),
+    path(
+        "upload/<str:token>/finalize",
+        views.UploadSessionFinalizeView.as_view(),
+        name="upload_finalize",
+    ),
     path("login", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("refresh", TokenRefreshView.as_view(), name="token_refresh"),
     path(
@@ -1,13 +1,101 @@
+import mmap
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.urls import reverse
+from PIL import Image as Img
+
+from .signing import signed_media_url
+
+TOKEN_PLACEHOLDER = "__token__"
+
+
 def image_format_from_json(image):
     if image.startswith("iVBORw0KGg"):
         format = (".png", "PNG")
     elif image.startswith("/9j/4"):
         format = (".jpeg", "JPEG")
+    elif image.startswith("R0lGOD"):
+        format = (".gif", "GIF")
+    elif image.startswith("UklGR"):
+        format = (".webp", "WEBP")
     else:
         format = None
     return format
 
 
+def init_pillow(plugins):
+    if not plugins:
+        return None
+    # standard drivers(BMP, GIF, JPEG, PPM, PNG), Pillow imports the rest
+    # only on the first file none of loaded plugins recognizes
+    Img.preinit()
+    for plugin in plugins:
+        # unlike importlib, __import__ is reported by -X importtime
+        __import__("PIL.%sImagePlugin" % plugin)
+    return None
+
+
+def delete_files(field_files):
+    for field_file in field_files:
+        # uncommitted files were never written to the storage
+        if field_file and field_file.name and field_file._committed:
+            field_file.storage.delete(field_file.name)
+
+
+def is_local(field_file):
+    return settings.THUMBNAIL_LOCAL_FAST_PATH and isinstance(
+        field_file.storage, FileSystemStorage
+    )
+
+
+@contextmanager
+def open_source(field_file):
+    # uncommitted file is not in the storage yet
+    if not is_local(field_file) or not field_file._committed:
+        yield field_file
+        return
+    # Pillow reads the page cache directly instead of through buffered
+    # reads of FieldFile
+    with open(field_file.path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped:
+        yield mapped
+
+
+def save_buffer(field_file, name, buffer):
+    if not is_local(field_file):
+        buffer.seek(0)
+        return field_file.save(name, File(buffer, name), save=False)
+    storage = field_file.storage
+    name = field_file.field.generate_filename(field_file.instance, name)
+    while True:
+        name = storage.get_available_name(
+            name, max_length=field_file.field.max_length
+        )
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            # file was created in the meantime, look for other name
+            continue
+        # encoder buffer is written without copying it to bytes
+        with os.fdopen(fd, "wb") as file:
+            file.write(buffer.getbuffer())
+        break
+    if storage.file_permissions_mode is not None:
+        os.chmod(path, storage.file_permissions_mode)
+    field_file.name = name
+    field_file._committed = True
+    setattr(field_file.instance, field_file.field.attname, name)
+    return None
+
+
 def update_thumbnails_after_changes_decorator(func):
     def wrapper(self, request, *args, **kwargs):
         try:
@@ -19,3 +107,35 @@ def update_thumbnails_after_changes_decorator(func):
         return func(self, request, *args, **kwargs)
 
     return wrapper
+
+
+class UrlBuilder:
+    def __init__(self, request):
+        # media can be served from other host, e.g. CDN in front of the API
+        base = settings.MEDIA_DOMAIN or request.build_absolute_uri("/")
+        self.base = base.rstrip("/")
+        self.routes = {}
+        self.issued = int(time.time())
+
+    def url(self, name, token):
+        route = self.routes.get(name)
+        if route is None:
+            route = self.routes[name] = reverse(
+                name, kwargs={"token": TOKEN_PLACEHOLDER}
+            ).split(TOKEN_PLACEHOLDER)
+        return "%s%s%s%s" % (self.base, route[0], token, route[1])
+
+    def thumbnail_url(self, thumbnail):
+        # signed URLs point straight to media files, served without Django
+        if settings.SIGNED_MEDIA_URLS:
+            return signed_media_url(
+                self.base, thumbnail.thumbnail.name, self.issued
+            )
+        return self.url("thumbnail_view", thumbnail.token)
+
+
+def get_url_builder(request):
+    builder = getattr(request, "_url_builder", None)
+    if builder is None:
+        builder = request._url_builder = UrlBuilder(request)
+    return builder
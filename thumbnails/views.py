@@ -1,17 +1,49 @@
-from django.http import FileResponse
+import mimetypes
+import os
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    StreamingHttpResponse,
+)
+from django.db import connections, router
+from django.db.models import Prefetch
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.utils.decorators import decorator_from_middleware
+from django.views import View
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.generics import (
+    CreateAPIView,
     DestroyAPIView,
+    GenericAPIView,
     ListCreateAPIView,
     RetrieveAPIView,
     UpdateAPIView,
 )
 from rest_framework.permissions import SAFE_METHODS, IsAuthenticated
+from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import perform_import
 
+from .caching import get_cache, list_key, list_ttl
+from .idempotency import idempotent
+from .instrumentation import timer
 from .middleware import DecodeBase64Middleware
-from .models import Image, ImageLink, Thumbnail
+from .models import (
+    Image,
+    ImageLink,
+    Size,
+    Thumbnail,
+    Tier,
+    UploadSession,
+    shard_for_user,
+    shard_from_token,
+)
 from .permissions import (
     BinaryImagePermission,
     ImagePermission,
@@ -23,15 +55,53 @@ from .serializers import (
     RetrieveImageSerializer,
     RetrieveLinkImageSerializer,
     RetrieveThumbnailSerializer,
+    UploadSessionSerializer,
+)
+from .throttling import RenderThrottle, render_slot
+from .uploads import (
+    SessionUploadedFile,
+    append_chunk,
+    append_lock,
+    discard,
+    get_hasher,
 )
 from .utils import update_thumbnails_after_changes_decorator
 
+MEDIA_AUTHENTICATION_CLASSES = perform_import(
+    settings.MEDIA_AUTHENTICATION_CLASSES, "MEDIA_AUTHENTICATION_CLASSES"
+)
+
+
+def file_response(field_file):
+    with timer("storage_open", field_file.size):
+        field_file.open("rb")
+    return FileResponse(field_file)
+
 
 class ImageCreateListView(ListCreateAPIView):
     permission_classes = [IsAuthenticated]
+    throttle_classes = [RenderThrottle]
 
     def get_queryset(self):
-        return Image.objects.filter(user=self.request.user)
+        return Image.objects.filter(
+            user=self.request.user, shard=shard_for_user(self.request.user.pk)
+        )
+
+    def filter_queryset(self, queryset):
+        # thumbnails are serialized from manifest of the image
+        return (
+            super()
+            .filter_queryset(queryset)
+            .select_related("user__tier")
+            .prefetch_related(
+                Prefetch(
+                    "expiring_link",
+                    queryset=ImageLink.objects.filter(
+                        shard=shard_for_user(self.request.user.pk)
+                    ),
+                )
+            )
+        )
 
     def get_serializer_class(self):
         if self.request.method in SAFE_METHODS:
@@ -39,11 +109,19 @@ class ImageCreateListView(ListCreateAPIView):
         return CreateUpdateImageSerializer
 
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        for image in queryset:
-            image.update_thumbnails()
-        return super().list(request, *args, **kwargs)
+        key = list_key(request)
+        data = get_cache().get(key)
+        if data is not None:
+            return Response(data)
+        # thumbnails only miss after changes of tier, which also change key
+        for image in self.filter_queryset(self.get_queryset()):
+            image.update_thumbnails_after_changes()
+        response = super().list(request, *args, **kwargs)
+        get_cache().set(key, response.data, list_ttl(request.user))
+        return response
 
+    @idempotent
+    @render_slot()
     @decorator_from_middleware(DecodeBase64Middleware)
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -55,19 +133,43 @@ class ImageCreateListView(ListCreateAPIView):
         return Response(data=serializer.data, status=201)
 
 
+def shard_filter(token, lookups):
+    # tokens without shard hint are looked up in every partition
+    shard = shard_from_token(token)
+    if shard is None:
+        return {}
+    return {lookup: shard for lookup in lookups}
+
+
 class RetrieveBaseView(RetrieveAPIView):
+    authentication_classes = MEDIA_AUTHENTICATION_CLASSES
+    related = None
+    shard_lookups = ("shard",)
+
+    def check_permissions(self, request):
+        with timer("permissions"):
+            return super().check_permissions(request)
+
     def get_object(self):
-        img = get_object_or_404(
-            self.model_class, token=self.kwargs.get("token")
-        )
-        return img
+        # permissions and reconciliation read the same row
+        if getattr(self, "_object", None) is None:
+            token = self.kwargs.get("token")
+            queryset = self.model_class.objects.filter(
+                **shard_filter(token, self.shard_lookups)
+            )
+            if self.related:
+                queryset = queryset.select_related(self.related)
+            self._object = get_object_or_404(queryset, token=token)
+        return self._object
 
 
 class RetrieveUpdateDestroyImageView(
     RetrieveBaseView, UpdateAPIView, DestroyAPIView
 ):
     permission_classes = [IsAuthenticated, ImagePermission]
+    throttle_classes = [RenderThrottle]
     model_class = Image
+    related = "user__tier"
 
     def get_serializer_class(self):
         if self.request.method in SAFE_METHODS:
@@ -78,12 +180,18 @@ class RetrieveUpdateDestroyImageView(
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
         # instance.update_thumbnails_after_changes()
-        return FileResponse(instance.image)
+        return file_response(instance.image)
 
+    def perform_destroy(self, instance):
+        # rows and files are removed later by purge_deleted_images
+        instance.soft_delete()
+
+    @render_slot()
     @decorator_from_middleware(DecodeBase64Middleware)
     def put(self, request, *args, **kwargs):
         return super().put(request, *args, **kwargs)
 
+    @render_slot()
     @decorator_from_middleware(DecodeBase64Middleware)
     def patch(self, request, *args, **kwargs):
         return super().put(request, *args, **kwargs)
@@ -92,16 +200,20 @@ class RetrieveUpdateDestroyImageView(
 class RetrieveDestroyThumbnailView(RetrieveBaseView, DestroyAPIView):
     permission_classes = [IsAuthenticated, ThumbnailPermission]
     model_class = Thumbnail
+    related = "image__user__tier"
+    shard_lookups = ("shard", "image__shard")
     serializer_class = RetrieveThumbnailSerializer
 
     @update_thumbnails_after_changes_decorator
     def retrieve(self, request, *args, **kwargs):
-        return FileResponse(self.get_object().thumbnail)
+        return file_response(self.get_object().thumbnail)
 
 
 class RetrieveBinaryImage(RetrieveBaseView):
     permission_classes = [IsAuthenticated, BinaryImagePermission]
     model_class = ImageLink
+    related = "image__user__tier"
+    shard_lookups = ("shard", "image__shard")
 
     @update_thumbnails_after_changes_decorator
     def retrieve(self, request, *args, **kwargs):
@@ -109,7 +221,7 @@ class RetrieveBinaryImage(RetrieveBaseView):
         if not image_link.is_valid():
             return Response(status=404)
         image = image_link.image
-        return FileResponse(image.image)
+        return file_response(image.image)
 
 
 class GenerateLinkToImageView(RetrieveBaseView):
@@ -123,3 +235,253 @@ class GenerateLinkToImageView(RetrieveBaseView):
             image_link, context={"request": request}
         )
         return Response(data=serializer.data)
+
+
+class UploadSessionCreateView(CreateAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(
+            data={
+                "filename": request.data.get("filename"),
+                "image": request.data.get("image"),
+                "length": request.headers.get("Upload-Length"),
+            }
+        )
+        serializer.is_valid(raise_exception=True)
+        session = serializer.save(token=UploadSession().generate_token())
+        os.makedirs(os.path.dirname(session.path), exist_ok=True)
+        open(session.path, "wb").close()
+        location = reverse("upload_view", kwargs={"token": session.token})
+        return Response(
+            status=201,
+            headers={
+                "Location": request.build_absolute_uri(location),
+                "Upload-Offset": 0,
+            },
+        )
+
+
+def release_connection(model):
+    # pooled connection waits in the pool while a slow client sends the
+    # body, the next query takes one again
+    connection = connections[router.db_for_write(model)]
+    if getattr(connection, "pool", None) and not connection.in_atomic_block:
+        connection.close()
+
+
+class UploadSessionBaseView(GenericAPIView):
+    permission_classes = [IsAuthenticated]
+
+    def get_object(self):
+        queryset = UploadSession.objects.filter(user=self.request.user)
+        session = get_object_or_404(queryset, token=self.kwargs.get("token"))
+        if session.is_expired():
+            discard(session)
+            session.delete()
+            raise Http404
+        return session
+
+
+class UploadSessionView(UploadSessionBaseView):
+    def head(self, request, *args, **kwargs):
+        session = self.get_object()
+        return Response(
+            headers={
+                "Upload-Offset": session.offset,
+                "Upload-Length": session.length,
+                "Cache-Control": "no-store",
+            }
+        )
+
+    def patch(self, request, *args, **kwargs):
+        if request.content_type != "application/offset+octet-stream":
+            return Response(status=415)
+        session = self.get_object()
+        with append_lock(session) as locked:
+            if not locked:
+                return Response(
+                    status=409, headers={"Upload-Offset": session.offset}
+                )
+            # other request may have appended before the lock was taken
+            session.refresh_from_db(fields=["offset"])
+            offset = session.offset
+            if request.headers.get("Upload-Offset") != str(offset):
+                return Response(status=409, headers={"Upload-Offset": offset})
+            content_length = int(request.headers.get("Content-Length") or 0)
+            if offset + content_length > session.length:
+                return Response(status=413)
+            release_connection(UploadSession)
+            append_chunk(session, request._request)
+            updated = UploadSession.objects.filter(
+                pk=session.pk, offset=offset
+            ).update(offset=session.offset)
+        if not updated:
+            return Response(status=409, headers={"Upload-Offset": offset})
+        return Response(status=204, headers={"Upload-Offset": session.offset})
+
+
+class UploadSessionFinalizeView(UploadSessionBaseView):
+    throttle_classes = [RenderThrottle]
+
+    @idempotent
+    @render_slot()
+    def post(self, request, *args, **kwargs):
+        session = self.get_object()
+        if session.offset != session.length:
+            return Response(
+                data={"detail": "Upload is incomplete."},
+                status=409,
+                headers={"Upload-Offset": session.offset},
+            )
+        checksum = request.data.get("sha256")
+        if checksum and checksum != get_hasher(session).hexdigest():
+            raise ValidationError({"sha256": "Checksum mismatch."})
+        upload = SessionUploadedFile(
+            session,
+            mimetypes.guess_type(session.filename)[0]
+            or "application/octet-stream",
+        )
+        try:
+            serializer = CreateUpdateImageSerializer(
+                session.image,
+                data={"image": upload},
+                context=self.get_serializer_context(),
+            )
+            serializer.is_valid(raise_exception=True)
+            instance = serializer.save()
+        finally:
+            upload.close()
+        discard(session)
+        session.delete()
+        serializer = ListImageSerializer(
+            instance, context={"request": request}
+        )
+        return Response(
+            data=serializer.data, status=200 if session.image_id else 201
+        )
+
+
+class AsyncRetrieveBaseView(View):
+    # subclasses define has_permission(user, obj) and get_file(obj)
+    http_method_names = ["get"]
+    chunk_size = 64 * 1024
+    model_class = None
+    related = None
+    shard_lookups = ("shard",)
+
+    async def get(self, request, *args, **kwargs):
+        user = await sync_to_async(self.authenticate)(request)
+        if not user.is_authenticated:
+            return HttpResponse(status=401)
+        token = self.kwargs.get("token")
+        queryset = self.model_class.objects.filter(
+            token=token, **shard_filter(token, self.shard_lookups)
+        )
+        if self.related:
+            queryset = queryset.select_related(self.related)
+        obj = await queryset.afirst()
+        if obj is None:
+            raise Http404
+        if not await self.has_permission(user, obj):
+            return HttpResponse(status=403)
+        field_file = await self.get_file(obj)
+        if field_file is None:
+            raise Http404
+        size = await sync_to_async(
+            field_file.storage.size, thread_sensitive=False
+        )(field_file.name)
+        response = StreamingHttpResponse(
+            self.stream(field_file),
+            content_type=(
+                mimetypes.guess_type(field_file.name)[0]
+                or "application/octet-stream"
+            ),
+        )
+        response["Content-Length"] = size
+        return response
+
+    def authenticate(self, request):
+        drf_request = Request(
+            request,
+            authenticators=[
+                auth() for auth in MEDIA_AUTHENTICATION_CLASSES
+            ],
+        )
+        try:
+            user = drf_request.user
+        except APIException:
+            return AnonymousUser()
+        # tier is read by every permission check, load it while still
+        # running in the worker thread
+        if user.is_authenticated:
+            user.tier
+        return user
+
+    async def stream(self, field_file):
+        file = await sync_to_async(
+            field_file.storage.open, thread_sensitive=False
+        )(field_file.name)
+        try:
+            while True:
+                chunk = await sync_to_async(
+                    file.read, thread_sensitive=False
+                )(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await sync_to_async(file.close, thread_sensitive=False)()
+
+
+class AsyncRetrieveImageView(AsyncRetrieveBaseView):
+    model_class = Image
+    related = "user__tier"
+
+    async def has_permission(self, user, obj):
+        return user.tier.original_image and obj.user_id == user.id
+
+    async def get_file(self, obj):
+        await sync_to_async(obj.update_thumbnails_after_changes)()
+        return obj.image
+
+
+class AsyncRetrieveThumbnailView(AsyncRetrieveBaseView):
+    model_class = Thumbnail
+    related = "image__user__tier"
+    shard_lookups = ("shard", "image__shard")
+
+    async def has_permission(self, user, obj):
+        if obj.image.user_id != user.id:
+            return False
+        heights = obj.image.manifest_heights(user.tier)
+        if heights is not None:
+            return obj.height in heights
+        return await Size.objects.filter(
+            tier=user.tier_id, height=obj.height
+        ).aexists()
+
+    async def get_file(self, obj):
+        await sync_to_async(obj.image.update_thumbnails_after_changes)()
+        if not await Thumbnail.objects.filter(pk=obj.pk).aexists():
+            return None
+        return obj.thumbnail
+
+
+class AsyncRetrieveBinaryImage(AsyncRetrieveBaseView):
+    model_class = ImageLink
+    related = "image__user__tier"
+    shard_lookups = ("shard", "image__shard")
+
+    async def has_permission(self, user, obj):
+        return (
+            user.tier.tier == Tier.Tiers.ENTERPRISE
+            and obj.image.user_id == user.id
+        )
+
+    async def get_file(self, obj):
+        if not await sync_to_async(obj.is_valid)():
+            return None
+        await sync_to_async(obj.image.update_thumbnails_after_changes)()
+        return obj.image.image